@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# Cache audio Ogg/Opus trên đĩa cho các bài hay được phát.
+#   - admission: bài phải được phát ít nhất `min_plays` lần mới được tải về (LFU)
+#   - eviction: khi vượt `max_bytes` thì xoá bài lâu không phát nhất (LRU)
+#   - việc tải chạy trong một worker nền, không chặn lúc phát
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    video_id TEXT PRIMARY KEY,
+    webpage_url TEXT NOT NULL,
+    plays INTEGER NOT NULL DEFAULT 0,
+    last_played REAL NOT NULL,
+    size INTEGER NOT NULL DEFAULT 0,
+    cached INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS tracks_last_played ON tracks (last_played);
+"""
+
+
+class AudioCache:
+    def __init__(self, directory, download, min_plays=3, max_bytes=2 * 1024 ** 3):
+        """`download(webpage_url, directory, video_id)` là hàm blocking trả về Path file .opus."""
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.download = download
+        self.min_plays = min_plays
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.filled = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.directory / "index.sqlite3"), check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+        self._pending = set()
+        self._queue = None
+        self._worker = None
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="audio-cache")
+
+    def file_for(self, video_id):
+        return self.directory / f"{video_id}.opus"
+
+    def lookup(self, video_id):
+        """Trả về Path file đã cache hoặc None."""
+        if not video_id:
+            return None
+        path = self.file_for(video_id)
+        with self._lock:
+            row = self._db.execute("SELECT cached FROM tracks WHERE video_id = ?", (video_id,)).fetchone()
+            if row and row[0] and path.exists():
+                self.hits += 1
+                return path
+            if row and row[0]:
+                # file bị xoá ngoài ý muốn
+                self._db.execute("UPDATE tracks SET cached = 0, size = 0 WHERE video_id = ?", (video_id,))
+            self.misses += 1
+        return None
+
+    def record_play(self, video_id, webpage_url):
+        if not video_id:
+            return
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO tracks (video_id, webpage_url, plays, last_played) VALUES (?, ?, 1, ?) "
+                "ON CONFLICT(video_id) DO UPDATE SET plays = plays + 1, last_played = excluded.last_played",
+                (video_id, webpage_url, time.time()),
+            )
+            plays, cached = self._db.execute(
+                "SELECT plays, cached FROM tracks WHERE video_id = ?", (video_id,)
+            ).fetchone()
+        if plays >= self.min_plays and not cached and video_id not in self._pending:
+            self._pending.add(video_id)
+            self._ensure_worker()
+            self._queue.put_nowait((video_id, webpage_url))
+
+    def _ensure_worker(self):
+        if self._worker is None or self._worker.done():
+            if self._queue is None:
+                self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._fill_worker())
+
+    async def _fill_worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            video_id, webpage_url = await self._queue.get()
+            try:
+                path = await loop.run_in_executor(
+                    self._executor, self.download, webpage_url, str(self.directory), video_id
+                )
+                size = path.stat().st_size
+                with self._lock:
+                    self._db.execute(
+                        "UPDATE tracks SET cached = 1, size = ? WHERE video_id = ?", (size, video_id)
+                    )
+                self.filled += 1
+                logging.info(f"Cached audio for {video_id} ({size / 1024 / 1024:.1f} MB)")
+                await loop.run_in_executor(self._executor, self._evict)
+            except Exception as e:
+                logging.warning(f"Audio cache fill failed for {video_id}: {e}")
+            finally:
+                self._pending.discard(video_id)
+
+    def _evict(self):
+        with self._lock:
+            total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM tracks WHERE cached = 1").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            rows = self._db.execute(
+                "SELECT video_id, size FROM tracks WHERE cached = 1 ORDER BY last_played ASC"
+            ).fetchall()
+            for video_id, size in rows:
+                if total <= self.max_bytes:
+                    break
+                self.file_for(video_id).unlink(missing_ok=True)
+                self._db.execute("UPDATE tracks SET cached = 0, size = 0 WHERE video_id = ?", (video_id,))
+                total -= size
+                self.evicted += 1
+                logging.info(f"Evicted cached audio for {video_id}")
+
+    def stats(self):
+        with self._lock:
+            count, total = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM tracks WHERE cached = 1"
+            ).fetchone()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "filled": self.filled,
+            "evicted": self.evicted,
+            "pending": len(self._pending),
+            "files": count,
+            "bytes": total,
+        }
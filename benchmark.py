@@ -0,0 +1,703 @@
+"""
+Benchmark / load test offline cho bot, không cần Discord hay YouTube.
+
+Chạy các handler /play, /skip, /queue và player thật của trcmusic.py với:
+  - YoutubeDL giả trả info dựng sẵn, có độ trễ và tỉ lệ lỗi tuỳ chỉnh
+  - một HTTP server cục bộ phục vụ file webm/opus
+  - voice client giả đọc frame 20 ms giống AudioPlayer của discord.py
+
+Mỗi mức số guild chạy trong một process riêng để số liệu bộ nhớ không lẫn nhau.
+Ví dụ:
+    python benchmark.py --guilds 1,10,50,100,500 --json bench.json
+    python benchmark.py --guilds 100 --extract-latency 0.5 --extract-error-rate 0.05
+    python benchmark.py --startup 5               # đo khởi động lạnh
+    PLAYBACK_MODE=pcm python benchmark.py --source ffmpeg --guilds 10   # CPU của từng playback mode
+    python benchmark.py --source ffmpeg --acodec aac --guilds 10       # ép ffmpeg encode lại
+Trả về exit code 1 nếu vượt ngưỡng (--max-ttfa-p95, --max-gap-p95, --max-failure-rate,
+--max-import-seconds). Mặc định không throttle theo host, không load shedding và dùng 16
+worker extract, để gate đo overhead của bot; cấu hình production thì chạy thêm
+--extract-workers 4 --host-rate 5 --shed-depth 20.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+FRAME_SECONDS = 0.02
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, round(p / 100 * (len(values) - 1))))
+    return values[k]
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def video_id_for(query):
+    return hashlib.sha1(query.encode()).hexdigest()[:11]
+
+
+# === Stand-in cho YouTube ===
+
+class FixtureServer:
+    """HTTP server phục vụ cùng một file audio ở mọi đường dẫn /track/<id>.webm."""
+
+    def __init__(self, payload, content_type):
+        payload_bytes = payload
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(payload_bytes)))
+                self.end_headers()
+                try:
+                    for i in range(0, len(payload_bytes), 64 * 1024):
+                        self.wfile.write(payload_bytes[i:i + 64 * 1024])
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def url_for(self, video_id):
+        return f"http://127.0.0.1:{self.port}/track/{video_id}.webm?expire={int(time.time()) + 6 * 3600}"
+
+
+def make_fake_youtubedl(server, track_seconds, latency, error_rate, seed, acodec="opus"):
+    import yt_dlp
+
+    rng = random.Random(seed)
+    rng_lock = threading.Lock()
+
+    class FakeYoutubeDL:
+        calls = 0
+
+        def __init__(self, params=None):
+            self.params = dict(params or {})
+
+        def extract_info(self, query, download=False):
+            with rng_lock:
+                FakeYoutubeDL.calls += 1
+                delay = latency * rng.uniform(0.5, 1.5)
+                fail = rng.random() < error_rate
+            time.sleep(delay)
+            if fail:
+                raise yt_dlp.utils.DownloadError(f"simulated extraction error for {query}")
+
+            if query.startswith("https://www.youtube.com/watch?v="):
+                video_id = query.rsplit("=", 1)[1]
+                return {
+                    "id": video_id,
+                    "title": f"Track {video_id}",
+                    "duration": track_seconds,
+                    "webpage_url": query,
+                    "url": server.url_for(video_id),
+                    "acodec": acodec,
+                    "format_id": "251",
+                    "ext": "webm",
+                }
+            # Tìm kiếm từ khoá: trả về kết quả flat như ytsearch1
+            video_id = video_id_for(query)
+            return {
+                "_type": "playlist",
+                "entries": [{
+                    "id": video_id,
+                    "url": f"https://www.youtube.com/watch?v={video_id}",
+                    "title": f"Track {video_id}",
+                    "duration": track_seconds,
+                }],
+            }
+
+        def sanitize_info(self, info):
+            return info
+
+        def close(self):
+            pass
+
+    return FakeYoutubeDL
+
+
+# === Stand-in cho Discord ===
+
+class HTTPFrameSource:
+    """Source không cần ffmpeg: đọc stream HTTP theo từng frame Opus cỡ cố định."""
+
+    def __init__(self, url, frame_bytes):
+        self.url = url
+        self.frame_bytes = frame_bytes
+        self._response = None
+
+    def read(self):
+        if self._response is None:
+            self._response = urllib.request.urlopen(self.url, timeout=10)
+        return self._response.read(self.frame_bytes)
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        if self._response is not None:
+            self._response.close()
+            self._response = None
+
+
+class FakeVoiceClient:
+    """Giả lập VoiceClient: mỗi lần play() chạy một thread đọc frame mỗi 20 ms rồi gọi after."""
+
+    def __init__(self, guild, channel, stats):
+        self.guild = guild
+        self.channel = channel
+        self.stats = stats
+        self._connected = True
+        self._source = None
+        self._paused = threading.Event()
+        self._stopped = False
+
+    def is_connected(self):
+        return self._connected
+
+    def is_playing(self):
+        return self._source is not None and not self._paused.is_set()
+
+    def is_paused(self):
+        return self._source is not None and self._paused.is_set()
+
+    def play(self, source, after=None):
+        if self._source is not None:
+            raise RuntimeError("Already playing audio.")
+        self._source = source
+        self._stopped = False
+        threading.Thread(target=self._play, args=(source, after), daemon=True).start()
+
+    def _play(self, source, after):
+        import discord
+
+        stats = self.stats
+        error = None
+        frames = 0
+        started = time.perf_counter()
+        try:
+            # Như AudioPlayer: source PCM được encode sang Opus ngay trên thread audio
+            encoder = None if source.is_opus() else discord.opus.Encoder()
+            while self._source is source:
+                if self._paused.is_set():
+                    time.sleep(FRAME_SECONDS)
+                    started = time.perf_counter() - frames * FRAME_SECONDS
+                    continue
+                data = source.read()
+                now = time.perf_counter()
+                if not data:
+                    break
+                if encoder is not None:
+                    encoder.encode(data, encoder.SAMPLES_PER_FRAME)
+                if frames == 0:
+                    stats.first_frame(now)
+                stats.last_frame_at = now
+                frames += 1
+                delay = started + frames * FRAME_SECONDS - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+        except Exception as e:
+            error = e
+        finally:
+            stats.frames += frames
+            stats.track_ended()
+            if self._source is source:
+                self._source = None
+            try:
+                source.cleanup()
+            except Exception:
+                pass
+        if after is not None:
+            after(error)
+
+    def stop(self):
+        self._stopped = True
+        self.stats.skipped_transition = True
+        self._source = None
+
+    def pause(self):
+        self._paused.set()
+
+    def resume(self):
+        self._paused.clear()
+
+    async def disconnect(self, force=False):
+        self.stop()
+        self._connected = False
+        self.guild.voice_client = None
+        self.stats.disconnected_at = time.perf_counter()
+
+
+class GuildStats:
+    def __init__(self):
+        self.requested_at = None
+        self.first_audio_at = None
+        self.last_frame_at = None
+        self.has_next = lambda: True  # queue còn bài kế tiếp không, run_guild gắn vào queue thật
+        self.next_queued = False      # lúc bài trước hết, bài kế tiếp đã có trong queue chưa
+        self.skipped_transition = False
+        self.disconnected_at = None
+        self.frames = 0
+        self.gaps = []
+        self.errors = 0
+        self.rejected = 0  # /play bị load shedding từ chối ("Busy")
+        self._lock = threading.Lock()
+
+    def first_frame(self, now):
+        with self._lock:
+            if self.first_audio_at is None:
+                self.first_audio_at = now
+            elif self.last_frame_at is not None and not self.skipped_transition and self.next_queued:
+                # Chỉ tính chuyển bài liền nhau: bài kế tiếp đã vào queue trước khi bài trước hết
+                self.gaps.append(now - self.last_frame_at)
+            self.skipped_transition = False
+
+    def track_ended(self):
+        with self._lock:
+            self.next_queued = self.has_next()
+
+    def connected(self):
+        # Guild vào lại voice sau khi hết queue: thời gian rảnh không phải khoảng lặng
+        with self._lock:
+            self.last_frame_at = None
+            self.disconnected_at = None
+
+
+def count_reply(stats, embed):
+    if embed is None:
+        return
+    if embed.title == "Busy":
+        stats.rejected += 1
+    elif embed.title == "Error":
+        stats.errors += 1
+
+
+class FakeMessage:
+    def __init__(self, message_id=0):
+        self.id = message_id
+
+    async def edit(self, **kwargs):
+        pass
+
+
+class FakeTextChannel:
+    def __init__(self, channel_id, stats):
+        self.id = channel_id
+        self.stats = stats
+        self.last_message_id = None
+
+    async def send(self, content=None, embed=None, **kwargs):
+        count_reply(self.stats, embed)
+        self.last_message_id = (self.last_message_id or 0) + 1
+        return FakeMessage(self.last_message_id)
+
+
+class FakeVoiceChannel:
+    def __init__(self, channel_id, guild, stats):
+        self.id = channel_id
+        self.guild = guild
+        self.stats = stats
+
+    async def connect(self, **kwargs):
+        self.stats.connected()
+        self.guild.voice_client = FakeVoiceClient(self.guild, self, self.stats)
+        return self.guild.voice_client
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.voice_client = None
+
+
+class FakeUser:
+    def __init__(self, name, voice_channel):
+        self.name = name
+        self.voice = type("VoiceState", (), {"channel": voice_channel})()
+
+
+class FakeResponse:
+    def __init__(self, stats):
+        self.stats = stats
+
+    async def defer(self, **kwargs):
+        pass
+
+    async def send_message(self, content=None, embed=None, **kwargs):
+        count_reply(self.stats, embed)
+
+
+class FakeFollowup(FakeResponse):
+    async def send(self, content=None, embed=None, **kwargs):
+        await self.send_message(content, embed)
+        return FakeMessage()
+
+
+class FakeInteraction:
+    def __init__(self, guild, user, channel, stats):
+        self.guild = guild
+        self.guild_id = guild.id
+        self.user = user
+        self.channel = channel
+        self.response = FakeResponse(stats)
+        self.followup = FakeFollowup(stats)
+
+    async def original_response(self):
+        return FakeMessage()
+
+
+# === Một mức tải, chạy trong process con ===
+
+def make_fixture(workdir, track_seconds, use_ffmpeg, frame_bytes):
+    if use_ffmpeg:
+        path = Path(workdir) / "track.webm"
+        subprocess.run(
+            ["ffmpeg", "-hide_banner", "-loglevel", "error", "-f", "lavfi",
+             "-i", f"sine=frequency=440:duration={track_seconds}", "-c:a", "libopus", "-b:a", "96k", "-y", str(path)],
+            check=True,
+        )
+        return path.read_bytes(), "audio/webm"
+    frames = int(track_seconds / FRAME_SECONDS)
+    return random.Random(0).randbytes(frames * frame_bytes), "application/octet-stream"
+
+
+async def run_guild(m, index, args, rng, stats):
+    guild = FakeGuild(1000 + index)
+    voice_channel = FakeVoiceChannel(2000 + index, guild, stats)
+    text_channel = FakeTextChannel(3000 + index, stats)
+    user = FakeUser(f"user{index}", voice_channel)
+    stats.has_next = lambda: bool(m.SONG_QUEUES.get(str(guild.id)))
+
+    await asyncio.sleep(rng.uniform(0, args.ramp))
+    admitted = False
+    for _ in range(args.songs):
+        query = f"benchmark track {rng.randrange(args.catalog)}"
+        if not admitted:
+            stats.requested_at = time.perf_counter()  # TTFA tính từ /play đầu tiên được nhận
+        rejected = stats.rejected
+        await m.play.callback(FakeInteraction(guild, user, text_channel, stats), query)
+        admitted = admitted or stats.rejected == rejected
+    await m.queue.callback(FakeInteraction(guild, user, text_channel, stats))
+
+    if args.skip and args.songs > 1:
+        await asyncio.sleep(args.track_seconds / 2)
+        await m.skip.callback(FakeInteraction(guild, user, text_channel, stats))
+
+    deadline = time.perf_counter() + args.songs * args.track_seconds * 3 + 30
+    while stats.disconnected_at is None and time.perf_counter() < deadline:
+        await asyncio.sleep(0.1)
+
+
+async def run_scale(m, args):
+    m.bot.loop = asyncio.get_running_loop()
+    m.STATE_STORE.start(lambda: list(m.CURRENT_SONG))
+    lag_task = asyncio.create_task(m.monitor_loop_lag())
+
+    peak_rss = [rss_bytes()]
+    max_lag = [0.0]
+
+    async def sample():
+        while True:
+            peak_rss[0] = max(peak_rss[0], rss_bytes())
+            max_lag[0] = max(max_lag[0], m.LOOP_LAG["last"])
+            await asyncio.sleep(0.25)
+
+    baseline_rss = rss_bytes()
+    sampler = asyncio.create_task(sample())
+    cpu_start = time.process_time()
+    children_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+    wall_start = time.perf_counter()
+
+    rng = random.Random(args.seed)
+    guild_stats = [GuildStats() for _ in range(args.guilds)]
+    await asyncio.gather(*(
+        run_guild(m, i, args, random.Random(rng.random()), guild_stats[i]) for i in range(args.guilds)
+    ))
+
+    wall = time.perf_counter() - wall_start
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = (time.process_time() - cpu_start
+           + children.ru_utime - children_start.ru_utime + children.ru_stime - children_start.ru_stime)
+    sampler.cancel()
+    lag_task.cancel()
+
+    ttfa = [s.first_audio_at - s.requested_at for s in guild_stats if s.first_audio_at is not None]
+    gaps = [gap for s in guild_stats for gap in s.gaps]
+    stream_seconds = sum(s.frames for s in guild_stats) * FRAME_SECONDS
+    tracks = {dict(k).get("result"): v for k, v in m.TRACK_RESULTS._values.items()}
+    played = tracks.get("played", 0)
+    failed = tracks.get("failed", 0) + tracks.get("quarantined", 0)
+    scheduler = m.EXTRACT_SCHEDULER.stats()
+
+    return {
+        "guilds": args.guilds,
+        "source": "ffmpeg" if args.ffmpeg else "raw",
+        "playback_mode": m.PLAYBACK_MODE,
+        "acodec": args.acodec,
+        "wall_seconds": wall,
+        "ttfa_p50": percentile(ttfa, 50),
+        "ttfa_p95": percentile(ttfa, 95),
+        "ttfa_max": max(ttfa) if ttfa else None,
+        # Guild bị từ chối hết mọi /play không phải là guild "không có tiếng"
+        "no_audio_guilds": sum(1 for s in guild_stats if s.first_audio_at is None and not s.rejected),
+        "rejected_guilds": sum(1 for s in guild_stats if s.first_audio_at is None and s.rejected),
+        "rejected": sum(s.rejected for s in guild_stats),
+        "gap_p50": percentile(gaps, 50),
+        "gap_p95": percentile(gaps, 95),
+        "gap_max": max(gaps) if gaps else None,
+        "tracks_played": played,
+        "tracks_failed": failed,
+        "failure_rate": failed / (played + failed) if played + failed else 0.0,
+        "command_errors": sum(s.errors for s in guild_stats),
+        "extractions": scheduler["completed"] + scheduler["failed"],
+        "extractions_per_second": (scheduler["completed"] + scheduler["failed"]) / wall if wall else 0.0,
+        "extract_wait_max": scheduler["wait_max"],
+        "singleflight_absorbed": m.EXTRACT_FLIGHTS.absorbed,
+        "cpu_seconds": cpu,
+        "cpu_percent_per_stream": 100 * cpu / stream_seconds if stream_seconds else None,
+        "memory_per_guild_kb": (peak_rss[0] - baseline_rss) / args.guilds / 1024,
+        "peak_rss_mb": peak_rss[0] / 1024 / 1024,
+        "loop_lag_max": max_lag[0],
+    }
+
+
+def isolate_environment(workdir):
+    os.environ["STATE_DB_PATH"] = os.path.join(workdir, "state.sqlite3")
+    os.environ["METADATA_CACHE_PATH"] = os.path.join(workdir, "metadata.sqlite3")
+    os.environ["COMMAND_HASH_PATH"] = os.path.join(workdir, "commands.json")
+    os.environ["EXTRACT_POOL"] = "thread"
+    os.environ["IDLE_LINGER_SECONDS"] = "0"  # mỗi guild rời voice ngay khi hết queue = kết thúc
+    os.environ.pop("AUDIO_CACHE_DIR", None)
+
+
+def worker(args):
+    workdir = tempfile.mkdtemp(prefix="trcmusic-bench-")
+    isolate_environment(workdir)
+    # Gate đo overhead của bot, không đo lại throttle/load shedding và số worker của production
+    # (5 lần/giây mỗi host, từ chối từ 20 job chờ, 4 worker); chỉnh bằng --host-rate,
+    # --shed-depth, --extract-workers. yt-dlp giả chỉ sleep nên thêm worker không tốn CPU.
+    os.environ["EXTRACT_WORKERS"] = str(args.extract_workers)
+    os.environ["EXTRACT_HOST_RATE"] = str(args.host_rate)
+    os.environ["EXTRACT_HOST_BURST"] = str(max(1, int(args.host_rate)))
+    os.environ["EXTRACT_SHED_DEPTH"] = str(args.shed_depth)
+    try:
+        import yt_dlp
+        import trcmusic as m
+
+        logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+        frame_bytes = m.OPUS_BITRATE * 1000 // 8 // 50
+        payload, content_type = make_fixture(workdir, args.track_seconds, args.ffmpeg, frame_bytes)
+        server = FixtureServer(payload, content_type)
+        yt_dlp.YoutubeDL = make_fake_youtubedl(
+            server, args.track_seconds, args.extract_latency, args.extract_error_rate, args.seed, args.acodec
+        )
+        if not args.ffmpeg:
+            async def create_raw_source(stream_url, acodec=None, start=0):
+                return HTTPFrameSource(stream_url, frame_bytes)
+            m.create_audio_source = create_raw_source
+
+        result = asyncio.run(run_scale(m, args))
+        server.httpd.shutdown()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(json.dumps(result))
+
+
+def startup_worker():
+    """Đo một lần khởi động lạnh: import trcmusic, hash command tree, warm-up yt-dlp."""
+    workdir = tempfile.mkdtemp(prefix="trcmusic-bench-")
+    isolate_environment(workdir)
+    try:
+        started = time.perf_counter()
+        import trcmusic as m
+        imported = time.perf_counter() - started
+        eager_yt_dlp = "yt_dlp" in sys.modules
+
+        started = time.perf_counter()
+        m.command_tree_hash()
+        command_hash = time.perf_counter() - started
+
+        started = time.perf_counter()
+        m.ytdl.warm_up()
+        warm_up = time.perf_counter() - started
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(json.dumps({
+        "import_seconds": imported,
+        "init_seconds": m.STARTUP["init"],
+        "command_hash_seconds": command_hash,
+        "warm_up_seconds": warm_up,
+        "eager_yt_dlp": eager_yt_dlp,
+    }))
+
+
+def run_startup(args):
+    runs = []
+    for _ in range(args.startup):
+        started = time.perf_counter()
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--startup-worker"], stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        if proc.returncode != 0 or not proc.stdout.strip():
+            print(f"Startup worker failed with exit code {proc.returncode}", file=sys.stderr)
+            return 2
+        run = json.loads(proc.stdout.strip().splitlines()[-1])
+        run["process_seconds"] = time.perf_counter() - started
+        runs.append(run)
+
+    summary = {key: percentile([r[key] for r in runs], 50)
+               for key in ("import_seconds", "init_seconds", "command_hash_seconds", "warm_up_seconds")}
+    summary["eager_yt_dlp"] = any(r["eager_yt_dlp"] for r in runs)
+    print(f"Startup over {len(runs)} cold run(s), medians:")
+    print(f"  import trcmusic      {format_seconds(summary['import_seconds'])}")
+    print(f"  module init          {format_seconds(summary['init_seconds'])}")
+    print(f"  command tree hash    {format_seconds(summary['command_hash_seconds'])}")
+    print(f"  yt-dlp warm-up (bg)  {format_seconds(summary['warm_up_seconds'])}")
+    print(f"  yt_dlp imported eagerly: {summary['eager_yt_dlp']}")
+    if args.json:
+        Path(args.json).write_text(json.dumps({"startup": summary, "runs": runs}, indent=2))
+    if summary["import_seconds"] > args.max_import_seconds:
+        print(f"FAIL: import time {format_seconds(summary['import_seconds'])} > {args.max_import_seconds}s",
+              file=sys.stderr)
+        return 1
+    return 0
+
+
+# === Điều phối và ngưỡng gate ===
+
+def format_seconds(value):
+    return "-" if value is None else f"{value * 1000:.0f}ms"
+
+
+def print_table(results):
+    header = (f"{'guilds':>6} {'ttfa p50':>9} {'ttfa p95':>9} {'gap p50':>8} {'gap p95':>8} {'fail':>6} "
+              f"{'rejected':>8} {'extr/s':>7} {'cpu%/str':>8} {'KB/guild':>9} {'lag max':>8}")
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        cpu = "-" if r["cpu_percent_per_stream"] is None else f"{r['cpu_percent_per_stream']:.2f}"
+        print(f"{r['guilds']:>6} {format_seconds(r['ttfa_p50']):>9} {format_seconds(r['ttfa_p95']):>9} "
+              f"{format_seconds(r['gap_p50']):>8} {format_seconds(r['gap_p95']):>8} {r['failure_rate']:>6.1%} "
+              f"{r['rejected']:>8} {r['extractions_per_second']:>7.1f} {cpu:>8} {r['memory_per_guild_kb']:>9.0f} "
+              f"{format_seconds(r['loop_lag_max']):>8}")
+
+
+def check_thresholds(results, args):
+    violations = []
+    for r in results:
+        if r["ttfa_p95"] is None or r["ttfa_p95"] > args.max_ttfa_p95:
+            violations.append(f"{r['guilds']} guilds: time-to-first-audio p95 {format_seconds(r['ttfa_p95'])} "
+                              f"> {args.max_ttfa_p95}s")
+        if r["gap_p95"] is not None and r["gap_p95"] > args.max_gap_p95:
+            violations.append(f"{r['guilds']} guilds: transition gap p95 {format_seconds(r['gap_p95'])} "
+                              f"> {args.max_gap_p95}s")
+        if r["failure_rate"] > args.max_failure_rate:
+            violations.append(f"{r['guilds']} guilds: failure rate {r['failure_rate']:.1%} "
+                              f"> {args.max_failure_rate:.1%}")
+        if r["no_audio_guilds"]:
+            violations.append(f"{r['guilds']} guilds: {r['no_audio_guilds']} guild(s) never got audio")
+    return violations
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark for the TRCMUSIC player")
+    parser.add_argument("--guilds", default="1,10,50,100,500", help="comma separated guild counts")
+    parser.add_argument("--songs", type=int, default=3, help="/play commands per guild")
+    parser.add_argument("--catalog", type=int, default=50, help="distinct tracks shared by all guilds")
+    parser.add_argument("--track-seconds", type=float, default=4.0)
+    parser.add_argument("--ramp", type=float, default=1.0, help="spread guild start over this many seconds")
+    parser.add_argument("--skip", action="store_true", help="each guild skips its first song halfway")
+    parser.add_argument("--extract-latency", type=float, default=0.2, help="mean fake yt-dlp latency (s)")
+    parser.add_argument("--extract-error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--source", choices=("auto", "ffmpeg", "raw"), default="auto",
+                        help="ffmpeg: real FFmpegOpusAudio; raw: read frames straight from HTTP")
+    parser.add_argument("--acodec", default="opus",
+                        help="codec the fake yt-dlp reports; anything but opus makes ffmpeg re-encode")
+    parser.add_argument("--extract-workers", type=int, default=16,
+                        help="EXTRACT_WORKERS for the run (production default is 4)")
+    parser.add_argument("--host-rate", type=float, default=1000.0,
+                        help="EXTRACT_HOST_RATE for the run (production default is 5)")
+    parser.add_argument("--shed-depth", type=int, default=100000,
+                        help="EXTRACT_SHED_DEPTH for the run (production default is 20)")
+    parser.add_argument("--max-ttfa-p95", type=float, default=3.0)
+    parser.add_argument("--max-gap-p95", type=float, default=0.5)
+    parser.add_argument("--max-failure-rate", type=float, default=0.01)
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("--startup", type=int, default=0, metavar="RUNS",
+                        help="measure cold start (import, command hash, yt-dlp warm-up) instead of load")
+    parser.add_argument("--max-import-seconds", type=float, default=1.5)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--startup-worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.source == "auto":
+        args.source = "ffmpeg" if shutil.which("ffmpeg") else "raw"
+    args.ffmpeg = args.source == "ffmpeg"
+    return args
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    args = parse_args(argv)
+    if args.startup_worker:
+        startup_worker()
+        return 0
+    if args.startup:
+        return run_startup(args)
+    if args.worker:
+        args.guilds = int(args.guilds)
+        worker(args)
+        return 0
+
+    results = []
+    for guilds in [int(g) for g in args.guilds.split(",") if g.strip()]:
+        cmd = [sys.executable, os.path.abspath(__file__), *argv, "--worker",
+               "--guilds", str(guilds), "--source", args.source]
+        print(f"Running {guilds} guild(s) with {args.source} sources...", file=sys.stderr)
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        if proc.returncode != 0 or not proc.stdout.strip():
+            print(f"Benchmark worker for {guilds} guild(s) failed with exit code {proc.returncode}", file=sys.stderr)
+            return 2
+        results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+
+    print_table(results)
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+
+    violations = check_thresholds(results, args)
+    for violation in violations:
+        print(f"FAIL: {violation}", file=sys.stderr)
+    return 1 if violations else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,59 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+
+# Kênh điều khiển cục bộ giữa launcher (supervisor) và các worker shard.
+# Mỗi worker nghe trên một Unix socket, mỗi request/response là một dòng JSON:
+#   -> {"cmd": "status"}
+#   <- {"ok": true, "result": {...}}
+
+
+async def serve(path, handlers):
+    """Chạy server điều khiển trên event loop của bot. `handlers` map tên lệnh -> coroutine function."""
+    if os.path.exists(path):
+        os.unlink(path)
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    cmd = request.pop("cmd", None)
+                    if cmd not in handlers:
+                        raise ValueError(f"unknown command {cmd!r}")
+                    response = {"ok": True, "result": await handlers[cmd](**request)}
+                except Exception as e:
+                    response = {"ok": False, "error": str(e)}
+                writer.write(json.dumps(response, default=str).encode() + b"\n")
+                await writer.drain()
+        except (ConnectionResetError, BrokenPipeError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_unix_server(handle, path=path)
+    logging.info(f"Control channel listening on {path}")
+    return server
+
+
+def request(path, cmd, timeout=2.0, **args):
+    """Gửi một lệnh tới worker (blocking, dùng ở launcher). Trả về result hoặc raise RuntimeError."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(json.dumps(dict(args, cmd=cmd)).encode() + b"\n")
+        data = b""
+        while not data.endswith(b"\n"):
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    response = json.loads(data)
+    if not response.get("ok"):
+        raise RuntimeError(response.get("error", "control request failed"))
+    return response["result"]
@@ -0,0 +1,141 @@
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+# Chế độ chẩn đoán (tắt mặc định, bật bằng DIAGNOSTICS=1 hoặc /diagnostics start):
+#   - thread lấy mẫu stack của mọi thread ~100 lần/giây -> profile dạng "collapsed stack"
+#     (mỗi dòng "thread;hàm;hàm số_mẫu"), đưa thẳng vào flamegraph.pl hay speedscope
+#   - heartbeat trên event loop: callback nào giữ loop quá SLOW_CALLBACK_SECONDS thì
+#     stack của loop trong lúc bị block được ghi lại thành một slow event
+#   - trace thời gian từng bước của các /play gần đây
+
+MAX_DEPTH = 64
+
+
+def _frame_name(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)})".replace(";", ":")
+
+
+def collapse(frame):
+    names = []
+    while frame is not None and len(names) < MAX_DEPTH:
+        names.append(_frame_name(frame.f_code))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def _thread_label(thread):
+    kind = type(thread).__name__
+    if kind not in ("Thread", "_MainThread", "_DummyThread"):
+        return kind  # vd. AudioPlayer của discord.py
+    return re.sub(r"[-_ ]?\d+.*$", "", thread.name) or "thread"
+
+
+class PlayTrace:
+    """Thời gian từng bước của một lần /play, tính từ lúc nhận lệnh."""
+
+    def __init__(self, guild_id, query, started=None):
+        self.guild_id = guild_id
+        self.query = query
+        self.started = started if started is not None else time.perf_counter()
+        self.stages = []
+        self._last = self.started
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.stages.append((stage, now - self._last))
+        self._last = now
+
+    def total(self):
+        return self._last - self.started
+
+    def describe(self):
+        return ", ".join(f"{stage} {seconds * 1000:.0f}ms" for stage, seconds in self.stages)
+
+
+class Diagnostics:
+    def __init__(self, sample_interval=0.01, slow_threshold=0.1, max_events=100):
+        self.sample_interval = sample_interval
+        self.slow_threshold = slow_threshold
+        self.enabled = False
+        self.started_at = None
+        self.samples = Counter()        # collapsed stack (mọi thread) -> số mẫu
+        self.slow_samples = Counter()   # stack của event loop lúc bị block -> số mẫu
+        self.slow_events = deque(maxlen=max_events)  # (time.time(), giây bị block, stack thường gặp nhất)
+        self.plays = deque(maxlen=50)   # PlayTrace đã xong
+        self._loop = None
+        self._loop_thread = None
+        self._heartbeat = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, loop):
+        """Gọi từ event loop cần theo dõi."""
+        if self.enabled:
+            return
+        if self._thread is not None:
+            self._thread.join(1.0)  # thread lấy mẫu của lần bật trước
+        self._loop = loop
+        self._loop_thread = threading.get_ident()
+        self.enabled = True
+        self.started_at = time.time()
+        self._stop.clear()
+        self._beat()
+        self._thread = threading.Thread(target=self._sample_forever, name="diagnostics", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.enabled = False
+        self._stop.set()
+
+    def reset(self):
+        self.samples.clear()
+        self.slow_samples.clear()
+        self.slow_events.clear()
+        self.plays.clear()
+        if self.enabled:
+            self.started_at = time.time()
+
+    def record_play(self, trace):
+        if self.enabled:
+            self.plays.append(trace)
+
+    def _beat(self):
+        self._heartbeat = time.perf_counter()
+        if self.enabled:
+            self._loop.call_later(self.sample_interval, self._beat)
+
+    def _sample_forever(self):
+        me = threading.get_ident()
+        blocked_since = None
+        blocked_stacks = Counter()
+        while not self._stop.wait(self.sample_interval):
+            labels = {thread.ident: _thread_label(thread) for thread in threading.enumerate()}
+            frames = sys._current_frames()
+            for thread_id, frame in frames.items():
+                if thread_id != me:
+                    self.samples[f"{labels.get(thread_id, 'thread')};{collapse(frame)}"] += 1
+
+            now = time.perf_counter()
+            stalled = now - self._heartbeat - self.sample_interval
+            if stalled >= self.slow_threshold:
+                frame = frames.get(self._loop_thread)
+                if frame is not None:
+                    stack = collapse(frame)
+                    blocked_stacks[stack] += 1
+                    self.slow_samples[stack] += 1
+                if blocked_since is None:
+                    blocked_since = self._heartbeat + self.sample_interval
+            elif blocked_since is not None:
+                top = blocked_stacks.most_common(1)[0][0] if blocked_stacks else ""
+                self.slow_events.append((time.time(), now - blocked_since, top))
+                blocked_since = None
+                blocked_stacks = Counter()
+
+    def folded(self, slow_only=False):
+        """Profile dạng collapsed stack, mỗi dòng "frame;frame;frame số_mẫu"."""
+        samples = self.slow_samples if slow_only else self.samples
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(list(samples.items())))
@@ -0,0 +1,255 @@
+import asyncio
+import itertools
+from collections import Counter
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import urlparse
+
+# Scheduler cho các lời gọi yt-dlp blocking:
+#   - pool riêng (thread hoặc process) thay cho default executor của event loop
+#   - priority queue: resolve "phát ngay" được chạy trước việc nạp playlist nền
+#   - trong cùng một priority, việc của các owner (guild) được xếp xoay vòng: một guild
+#     nạp playlist 500 bài không bắt guild khác chờ hết 500 bài mới tới lượt
+#   - token bucket theo host để không bị YouTube rate-limit; job của host đang hết token
+#     được trả lại hàng đợi khi có token thay vì giữ worker, nên không chặn việc gấp hơn
+#   - job đang chờ có key thì nâng được priority (reprioritise), job đã chạy thì thôi
+#   - số liệu độ sâu hàng đợi và thời gian chờ
+
+PRIORITY_PLAY_NOW = 0
+PRIORITY_SEARCH = 1
+PRIORITY_AUTOCOMPLETE = 3
+PRIORITY_PREFETCH = 5
+PRIORITY_BACKGROUND = 10
+
+
+def host_of(target):
+    if not target or target.startswith("ytsearch") or "://" not in target:
+        return "youtube"
+    host = urlparse(target).netloc.lower()
+    if host == "youtu.be" or host.endswith("youtube.com"):
+        return "youtube"
+    return host
+
+
+def _init_worker_logging():
+    # Process con import lại trcmusic.py nên có QueueHandler của bot; ghi thẳng ra stderr
+    # cho chắc, không phụ thuộc thread QueueListener của process con
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - [extract %(process)d] %(message)s"))
+    root.addHandler(handler)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def reserve(self):
+        """Lấy một token, trả về số giây phải chờ trước khi được dùng nó."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def take(self):
+        """Lấy một token nếu có và trả về 0, không thì trả về số giây tới khi có (không lấy)."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class _Job:
+    __slots__ = ("fn", "args", "future", "host", "key", "priority", "turn", "seq", "enqueued",
+                 "deferred", "throttled")
+
+    def __init__(self, fn, args, future, host, key, priority, turn):
+        self.fn = fn
+        self.args = args
+        self.future = future
+        self.host = host
+        self.key = key
+        self.priority = priority
+        self.turn = turn
+        self.seq = None         # seq của entry còn hiệu lực trong heap, entry cũ hơn là stale
+        self.enqueued = time.monotonic()
+        self.deferred = False   # đang ngoài hàng đợi chờ token của host
+        self.throttled = False
+
+
+class ExtractionScheduler:
+    def __init__(self, workers=4, use_processes=False, host_rate=5.0, host_burst=10, wait_histogram=None):
+        self.workers = workers
+        self.host_rate = host_rate
+        self.host_burst = host_burst
+        self.wait_histogram = wait_histogram  # metrics.Histogram, thời gian chờ theo priority
+        if use_processes:
+            # spawn: pool được tạo lúc bot đã có thread (log listener, state store, audio), fork
+            # lúc đó có thể để lại lock đang bị giữ trong process con. Process con import lại
+            # trcmusic.py dưới tên __mp_main__ (bot chỉ chạy khi __name__ == "__main__"),
+            # chỉ tốn một lần import mỗi worker.
+            self.executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"),
+                                                initializer=_init_worker_logging)
+        else:
+            self.executor = ThreadPoolExecutor(workers, thread_name_prefix="ytdl")
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.throttled = 0
+        self.reprioritised = 0
+        self.running = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._buckets = {}
+        self._waiting = Counter()  # priority -> số job đang chờ
+        self._turns = {}           # priority -> lượt đang được phục vụ
+        self._next_turns = {}      # (priority, owner) -> lượt kế tiếp của owner
+        self._jobs = {}            # key -> _Job chưa chạy, để reprioritise
+        self._queue = None
+        self._tasks = []
+        self._seq = itertools.count()
+
+    def _ensure_started(self):
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def submit(self, fn, *args, priority=PRIORITY_BACKGROUND, host=None, owner=None, key=None):
+        """`key`: định danh job (vd. key của SingleFlight) để reprioritise khi nó còn chờ."""
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        self.submitted += 1
+        turn = self._turns.get(priority, 0)
+        if owner is not None:
+            # Mỗi owner chỉ có một job ở mỗi lượt: job thứ n của owner xếp sau job đầu của owner khác
+            turn = max(turn, self._next_turns.get((priority, owner), 0))
+            self._next_turns[(priority, owner)] = turn + 1
+        job = _Job(fn, args, future, host or "default", key, priority, turn)
+        if key is not None:
+            self._jobs[key] = job
+        self._waiting[priority] += 1
+        self._push(job)
+        try:
+            return await future
+        finally:
+            self._forget(job)
+
+    def reprioritise(self, key, priority):
+        """Nâng priority của job `key` nếu nó chưa chạy. Trả về True nếu đã nâng."""
+        job = self._jobs.get(key)
+        if job is None or job.future.done() or priority >= job.priority:
+            return False
+        self._waiting[job.priority] -= 1
+        self._waiting[priority] += 1
+        job.priority = priority
+        job.turn = self._turns.get(priority, 0)
+        if not job.deferred:
+            self._push(job)  # entry cũ trong heap thành stale
+        self.reprioritised += 1
+        return True
+
+    def _push(self, job):
+        job.seq = next(self._seq)
+        self._queue.put_nowait((job.priority, job.turn, job.seq, job))
+
+    def _forget(self, job):
+        if job.key is not None and self._jobs.get(job.key) is job:
+            del self._jobs[job.key]
+
+    def _requeue(self, job):
+        job.deferred = False
+        self._push(job)
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            priority, turn, seq, job = await self._queue.get()
+            if seq != job.seq:
+                continue  # đã được reprioritise, entry mới nằm chỗ khác trong heap
+            if turn > self._turns.get(priority, 0):
+                self._turns[priority] = turn
+                self._prune_turns()
+            if job.future.done():
+                self._waiting[priority] -= 1
+                continue
+
+            bucket = self._buckets.get(job.host)
+            if bucket is None:
+                bucket = self._buckets[job.host] = TokenBucket(self.host_rate, self.host_burst)
+            delay = bucket.take()
+            if delay > 0:
+                # Host hết token: trả job về hàng đợi khi có token, worker đi lấy job khác
+                if not job.throttled:
+                    job.throttled = True
+                    self.throttled += 1
+                job.deferred = True
+                loop.call_later(delay, self._requeue, job)
+                continue
+
+            self._waiting[priority] -= 1
+            self._forget(job)
+            waited = time.monotonic() - job.enqueued
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            if self.wait_histogram is not None:
+                self.wait_histogram.observe(waited, priority=str(priority))
+            self.running += 1
+            try:
+                result = await loop.run_in_executor(self.executor, job.fn, *job.args)
+            except Exception as e:
+                self.failed += 1
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                self.completed += 1
+                if not job.future.done():
+                    job.future.set_result(result)
+            finally:
+                self.running -= 1
+
+    def _prune_turns(self):
+        # Owner đã tụt lại sau lượt hiện tại thì không cần nhớ nữa
+        if len(self._next_turns) > 1024:
+            self._next_turns = {key: turn for key, turn in self._next_turns.items()
+                                if turn > self._turns.get(key[0], 0)}
+
+    def queue_depth(self):
+        """Số job chưa chạy, kể cả job đang chờ token (heap còn chứa entry stale nên không dùng qsize)."""
+        return sum(self._waiting.values())
+
+    def waiting(self, max_priority):
+        """Số job đang chờ có priority <= max_priority (vd. chỉ tính việc người dùng đang chờ)."""
+        return sum(count for priority, count in self._waiting.items() if priority <= max_priority)
+
+    def stats(self):
+        started = self.completed + self.failed + self.running
+        return {
+            "queue_depth": self.queue_depth(),
+            "running": self.running,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "throttled": self.throttled,
+            "reprioritised": self.reprioritised,
+            "wait_avg": self.wait_total / started if started else 0.0,
+            "wait_max": self.wait_max,
+        }
+
+    def shutdown(self):
+        for task in self._tasks:
+            task.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        logging.info("Extraction scheduler stopped")
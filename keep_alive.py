@@ -1,15 +1,70 @@
-from flask import Flask 
+import os
+import hmac
+from flask import Flask, Response, jsonify, request
 from threading import Thread
 
+from metrics import REGISTRY
+
 app = Flask('')
+HEALTH_CHECK = None  # hàm trả về (ok, dict), do bot đăng ký
+DIAGNOSTICS = None   # (profile(slow_only) -> str | None, report() -> dict), do bot đăng ký
+DIAGNOSTICS_TOKEN = os.getenv("DIAGNOSTICS_TOKEN")  # /debug/* chỉ mở khi đặt, và cần ?token=
+
+def set_health_check(check):
+    global HEALTH_CHECK
+    HEALTH_CHECK = check
+
+def set_diagnostics(profile, report):
+    global DIAGNOSTICS
+    DIAGNOSTICS = (profile, report)
 
 @app.route('/')
 def home():
     return "Tao con song"
 
+@app.route('/metrics')
+def metrics():
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route('/healthz')
+def healthz():
+    if HEALTH_CHECK is None:
+        return jsonify({"status": "starting"}), 503
+    try:
+        ok, details = HEALTH_CHECK()
+    except Exception as e:
+        return jsonify({"status": "error", "error": str(e)}), 503
+    return jsonify(details), 200 if ok else 503
+
+def _debug_allowed():
+    # Cổng keep-alive là public: không có token thì không phục vụ dữ liệu chẩn đoán
+    token = request.args.get("token", "")
+    return bool(DIAGNOSTICS_TOKEN) and hmac.compare_digest(token.encode(), DIAGNOSTICS_TOKEN.encode())
+
+@app.route('/debug/profile')
+def debug_profile():
+    # Collapsed stack, dùng được ngay với flamegraph.pl / speedscope; ?slow=1 chỉ lấy lúc loop bị block
+    if DIAGNOSTICS is None or not DIAGNOSTICS_TOKEN:
+        return "diagnostics not available\n", 404
+    if not _debug_allowed():
+        return "forbidden\n", 403
+    profile = DIAGNOSTICS[0](request.args.get("slow") == "1")
+    if profile is None:
+        return "diagnostics mode is off\n", 404
+    return Response(profile, mimetype="text/plain")
+
+@app.route('/debug/diagnostics')
+def debug_diagnostics():
+    if DIAGNOSTICS is None or not DIAGNOSTICS_TOKEN:
+        return jsonify({"error": "diagnostics not available"}), 404
+    if not _debug_allowed():
+        return jsonify({"error": "forbidden"}), 403
+    return jsonify(DIAGNOSTICS[1]())
+
 def run():
-    app.run(host='0.0.0.0', port=8080)
+    app.run(host='0.0.0.0', port=int(os.getenv("KEEP_ALIVE_PORT", "8080")))
 
 def keep_alive():
-    t = Thread(target=run)
-    t.start()
\ No newline at end of file
+    # daemon để process thoát được khi bot dừng (launcher cần điều đó để restart worker)
+    t = Thread(target=run, daemon=True)
+    t.start()
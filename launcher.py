@@ -0,0 +1,257 @@
+"""
+Chạy bot ở chế độ sharded trên nhiều worker process (mỗi process một dải shard).
+
+    python launcher.py --processes 4             # số shard theo khuyến nghị của Discord
+    python launcher.py --processes 2 --shards 8
+    python launcher.py status                    # trạng thái gộp của mọi worker
+    python launcher.py reconnect 3               # reconnect riêng shard 3
+    python launcher.py restart 3                 # restart worker đang giữ shard 3
+
+Launcher giám sát các worker qua kênh điều khiển (control.py), tự khởi động lại
+worker bị chết với backoff, và phục vụ /healthz, /metrics gộp trên cổng keep-alive.
+Worker thứ i phục vụ /metrics riêng của nó trên cổng KEEP_ALIVE_PORT + i + 1.
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+from dotenv import load_dotenv
+
+import control
+from keep_alive import keep_alive, set_health_check
+from metrics import REGISTRY
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "trcmusic.py")
+RUN_DIR = os.getenv("LAUNCHER_RUN_DIR", "/tmp/trcmusic-launcher")
+POLL_INTERVAL = 5
+RESTART_BACKOFF_MAX = 60
+STABLE_SECONDS = 600   # worker chạy ổn chừng này thì reset bộ đếm backoff
+IDENTIFY_INTERVAL = 5.5  # Discord cho mỗi bucket max_concurrency identify một lần / 5 giây
+SHUTDOWN_TIMEOUT = 15
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - [launcher] %(message)s")
+
+
+def gateway_info(token):
+    """Hỏi Discord số shard khuyên dùng và max_concurrency của bot."""
+    req = urllib.request.Request(
+        "https://discord.com/api/v10/gateway/bot",
+        headers={"Authorization": f"Bot {token}", "User-Agent": "DiscordBot (trcmusic launcher, 1.0)"},
+    )
+    with urllib.request.urlopen(req, timeout=10) as response:
+        info = json.load(response)
+    return info["shards"], info.get("session_start_limit", {}).get("max_concurrency", 1)
+
+
+def split_shards(shard_count, processes):
+    processes = max(1, min(processes, shard_count))
+    base, extra = divmod(shard_count, processes)
+    ranges = []
+    start = 0
+    for i in range(processes):
+        size = base + (1 if i < extra else 0)
+        ranges.append(list(range(start, start + size)))
+        start += size
+    return ranges
+
+
+class Worker:
+    def __init__(self, index, shard_ids, shard_count, base_port):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.port = base_port + index + 1
+        self.socket_path = os.path.join(RUN_DIR, f"worker-{index}.sock")
+        self.process = None
+        self.started_at = None
+        self.restarts = 0
+        self.restart_at = None
+        self.status = None
+
+    def start(self):
+        env = dict(
+            os.environ,
+            SHARD_COUNT=str(self.shard_count),
+            SHARD_IDS=",".join(map(str, self.shard_ids)),
+            CONTROL_SOCKET=self.socket_path,
+            KEEP_ALIVE_PORT=str(self.port),
+        )
+        self.process = subprocess.Popen([sys.executable, BOT_SCRIPT], env=env)
+        self.started_at = time.monotonic()
+        self.restart_at = None
+        self.status = None
+        logging.info(f"Started worker {self.index} (pid {self.process.pid}) for shards {self.shard_ids}")
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def poll(self):
+        try:
+            self.status = control.request(self.socket_path, "status")
+        except (OSError, RuntimeError, ValueError):
+            self.status = None  # đang khởi động hoặc bị treo
+        return self.status
+
+
+class Supervisor:
+    def __init__(self, workers, identify_delay):
+        self.workers = workers
+        self.identify_delay = identify_delay
+        self.stopping = threading.Event()
+
+    def run(self):
+        for i, worker in enumerate(self.workers):
+            if self.stopping.is_set():
+                break
+            worker.start()
+            if i < len(self.workers) - 1:
+                # Các worker identify lần lượt để không vượt giới hạn identify của Discord
+                self.stopping.wait(self.identify_delay * len(worker.shard_ids))
+
+        while not self.stopping.is_set():
+            now = time.monotonic()
+            for worker in self.workers:
+                if worker.alive():
+                    worker.poll()
+                    if worker.restarts and now - worker.started_at > STABLE_SECONDS:
+                        worker.restarts = 0
+                elif worker.restart_at is None:
+                    worker.restarts += 1
+                    delay = min(RESTART_BACKOFF_MAX, 2 ** worker.restarts)
+                    worker.restart_at = now + delay
+                    worker.status = None
+                    logging.warning(f"Worker {worker.index} exited with code {worker.process.returncode}, "
+                                    f"restarting in {delay}s")
+                elif now >= worker.restart_at:
+                    worker.start()
+            self.stopping.wait(POLL_INTERVAL)
+        self.shutdown()
+
+    def shutdown(self):
+        for worker in self.workers:
+            if worker.alive():
+                try:
+                    control.request(worker.socket_path, "shutdown")
+                except (OSError, RuntimeError, ValueError):
+                    worker.process.terminate()
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        for worker in self.workers:
+            if worker.process is None:
+                continue
+            try:
+                worker.process.wait(max(0.1, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                logging.warning(f"Worker {worker.index} did not stop in time, killing it")
+                worker.process.kill()
+        logging.info("All workers stopped")
+
+    def health(self):
+        workers = []
+        ok = True
+        for worker in self.workers:
+            status = worker.status
+            up = worker.alive() and status is not None and status["ready"] and status["health"] != "down"
+            ok = ok and up
+            workers.append({
+                "index": worker.index,
+                "shards": worker.shard_ids,
+                "pid": worker.process.pid if worker.alive() else None,
+                "restarts": worker.restarts,
+                "status": status["health"] if status else ("starting" if worker.alive() else "down"),
+            })
+        return ok, {"status": "ok" if ok else "degraded", "workers": workers}
+
+    def collect(self):
+        workers = list(self.workers)
+        statuses = [(w, w.status or {}) for w in workers]
+        return [
+            ("trcmusic_launcher_worker_up", "gauge", "Whether each worker process is running and answering",
+             [({"worker": w.index}, 1 if w.alive() and w.status else 0) for w in workers]),
+            ("trcmusic_launcher_worker_restarts", "gauge", "Restarts of each worker since it was last stable",
+             [({"worker": w.index}, w.restarts) for w in workers]),
+            ("trcmusic_launcher_guilds", "gauge", "Guilds served by each worker",
+             [({"worker": w.index}, s.get("guilds", 0)) for w, s in statuses]),
+            ("trcmusic_launcher_voice_clients", "gauge", "Voice clients of each worker",
+             [({"worker": w.index}, s.get("voice_clients", 0)) for w, s in statuses]),
+            ("trcmusic_launcher_queued", "gauge", "Songs queued across the guilds of each worker",
+             [({"worker": w.index}, s.get("queued", 0)) for w, s in statuses]),
+        ]
+
+
+def worker_statuses():
+    statuses = []
+    for path in sorted(glob.glob(os.path.join(RUN_DIR, "worker-*.sock"))):
+        try:
+            statuses.append((path, control.request(path, "status")))
+        except (OSError, RuntimeError, ValueError) as e:
+            statuses.append((path, {"error": str(e)}))
+    return statuses
+
+
+def find_worker(shard_id):
+    for path, status in worker_statuses():
+        if shard_id in (status.get("shard_ids") or []):
+            return path
+    raise SystemExit(f"No running worker owns shard {shard_id}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run TRCMUSIC as sharded worker processes")
+    parser.add_argument("command", nargs="?", default="run", choices=("run", "status", "reconnect", "restart"))
+    parser.add_argument("shard", nargs="?", type=int, help="shard id for reconnect/restart")
+    parser.add_argument("--processes", type=int, default=int(os.getenv("SHARD_PROCESSES", str(os.cpu_count() or 1))))
+    parser.add_argument("--shards", type=int, default=int(os.getenv("SHARD_TOTAL", "0")),
+                        help="total shard count (default: Discord's recommendation)")
+    args = parser.parse_args()
+
+    if args.command == "status":
+        print(json.dumps([status for _, status in worker_statuses()], indent=2, default=str))
+        return
+    if args.command in ("reconnect", "restart"):
+        if args.shard is None:
+            parser.error(f"{args.command} needs a shard id")
+        path = find_worker(args.shard)
+        if args.command == "reconnect":
+            print(control.request(path, "reconnect_shard", timeout=30, shard_id=args.shard))
+        else:
+            # Worker tự thoát, supervisor sẽ khởi động lại nó
+            print(control.request(path, "shutdown"))
+        return
+
+    load_dotenv()
+    max_concurrency = 1
+    shard_count = args.shards
+    if not shard_count:
+        shard_count, max_concurrency = gateway_info(os.getenv("DISCORD_TOKEN"))
+        logging.info(f"Discord recommends {shard_count} shard(s)")
+
+    os.makedirs(RUN_DIR, exist_ok=True)
+    base_port = int(os.getenv("KEEP_ALIVE_PORT", "8080"))
+    workers = [Worker(i, shard_ids, shard_count, base_port)
+               for i, shard_ids in enumerate(split_shards(shard_count, args.processes))]
+    supervisor = Supervisor(workers, IDENTIFY_INTERVAL / max_concurrency)
+
+    set_health_check(supervisor.health)
+    REGISTRY.add_collector(supervisor.collect)
+    keep_alive()
+
+    def stop(signum, frame):
+        logging.info(f"Received signal {signum}, stopping workers")
+        supervisor.stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logging.info(f"Running {shard_count} shard(s) on {len(workers)} worker process(es)")
+    supervisor.run()
+
+
+if __name__ == "__main__":
+    main()
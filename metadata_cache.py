@@ -0,0 +1,203 @@
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse, parse_qs
+
+# Cache metadata của yt-dlp trên đĩa (SQLite) để /play lặp lại không phải gọi mạng:
+#   queries: query đã chuẩn hoá -> video_id (kết quả ytsearch1)
+#   videos : video_id -> title, duration, webpage_url, format đã chọn
+# Chỉ stream URL (sống vài giờ) là vẫn phải resolve lại.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS queries (
+    query TEXT PRIMARY KEY,
+    video_id TEXT NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS videos (
+    video_id TEXT PRIMARY KEY,
+    title TEXT,
+    duration REAL,
+    webpage_url TEXT NOT NULL,
+    format_id TEXT,
+    acodec TEXT,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS queries_accessed ON queries (accessed);
+CREATE INDEX IF NOT EXISTS videos_accessed ON videos (accessed);
+"""
+
+YOUTUBE_HOSTS = ("youtube.com", "www.youtube.com", "m.youtube.com", "music.youtube.com")
+
+
+def normalize_query(query):
+    # Chỉ hạ chữ thường với từ khoá; URL giữ nguyên vì ID video/playlist phân biệt hoa thường
+    if "://" in query:
+        return query.strip()
+    return " ".join(query.lower().split())
+
+
+def youtube_video_id(url):
+    if not url or "://" not in url:
+        return None
+    parsed = urlparse(url)
+    host = parsed.netloc.lower()
+    if host == "youtu.be":
+        video_id = parsed.path.lstrip("/").split("/", 1)[0]
+    elif host in YOUTUBE_HOSTS:
+        if parsed.path == "/watch":
+            video_id = parse_qs(parsed.query).get("v", [None])[0]
+        elif parsed.path.startswith(("/shorts/", "/live/", "/embed/")):
+            video_id = parsed.path.split("/")[2]
+        else:
+            return None
+    else:
+        return None
+    if video_id and len(video_id) == 11:
+        return video_id
+    return None
+
+
+class MetadataCache:
+    def __init__(self, path, max_entries=5000, ttl=7 * 24 * 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = {"query": 0, "video": 0}
+        self.misses = {"query": 0, "video": 0}
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+
+    def lookup(self, query):
+        """Trả về dict metadata cho query (URL video hoặc từ khoá), None nếu miss."""
+        video_id = youtube_video_id(query)
+        if video_id:
+            return self.get_video(video_id)
+        if "://" in query:
+            return None
+        return self.get_query(query)
+
+    def get_query(self, query):
+        key = normalize_query(query)
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT video_id, created FROM queries WHERE query = ?", (key,)
+            ).fetchone()
+            if row and row[1] + self.ttl > now:
+                self._db.execute("UPDATE queries SET accessed = ? WHERE query = ?", (now, key))
+                video_id = row[0]
+            else:
+                if row:
+                    self._db.execute("DELETE FROM queries WHERE query = ?", (key,))
+                self.misses["query"] += 1
+                return None
+        info = self.get_video(video_id)
+        with self._lock:
+            if info:
+                self.hits["query"] += 1
+            else:
+                self.misses["query"] += 1
+        return info
+
+    def get_video(self, video_id):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT title, duration, webpage_url, format_id, acodec, created "
+                "FROM videos WHERE video_id = ?", (video_id,)
+            ).fetchone()
+            if not row or row[5] + self.ttl <= now:
+                if row:
+                    self._db.execute("DELETE FROM videos WHERE video_id = ?", (video_id,))
+                self.misses["video"] += 1
+                return None
+            self._db.execute("UPDATE videos SET accessed = ? WHERE video_id = ?", (now, video_id))
+            self.hits["video"] += 1
+        title, duration, webpage_url, format_id, acodec, _ = row
+        return {
+            "id": video_id,
+            "title": title,
+            "duration": duration,
+            "webpage_url": webpage_url,
+            "format_id": format_id,
+            "acodec": acodec,
+        }
+
+    def put_query(self, query, info):
+        video_id = self.put_videos([info])
+        if not video_id:
+            return
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO queries (query, video_id, created, accessed) VALUES (?, ?, ?, ?)",
+                (normalize_query(query), video_id, now, now),
+            )
+            self._after_write(1)
+
+    def put_videos(self, entries):
+        """Lưu metadata cho các entry là video YouTube, trả về video_id của entry cuối."""
+        rows = []
+        now = time.time()
+        for info in entries:
+            if not info or not info.get("title") or not info.get("duration"):
+                continue
+            webpage_url = info.get("webpage_url") or info.get("url")
+            video_id = youtube_video_id(webpage_url)
+            if not video_id:
+                continue
+            rows.append((video_id, info["title"], info["duration"], webpage_url,
+                         info.get("format_id"), info.get("acodec"), now, now))
+        if not rows:
+            return None
+        with self._lock, self._db:
+            self._db.execute("BEGIN")
+            # Entry flat (không có format) không được ghi đè format đã biết từ lần resolve trước
+            self._db.executemany(
+                "INSERT INTO videos (video_id, title, duration, webpage_url, format_id, acodec, created, accessed) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(video_id) DO UPDATE SET title = excluded.title, duration = excluded.duration, "
+                "webpage_url = excluded.webpage_url, "
+                "format_id = COALESCE(excluded.format_id, videos.format_id), "
+                "acodec = COALESCE(excluded.acodec, videos.acodec), "
+                "created = excluded.created, accessed = excluded.accessed",
+                rows,
+            )
+        with self._lock:
+            self._after_write(len(rows))
+        return rows[-1][0]
+
+    def search_terms(self):
+        """(video_id, title, duration, webpage_url, query) của mọi video còn hạn, dùng ít gần đây trước."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT v.video_id, v.title, v.duration, v.webpage_url, q.query FROM videos v "
+                "LEFT JOIN queries q ON q.video_id = v.video_id "
+                "WHERE v.created + ? > ? AND v.title IS NOT NULL ORDER BY v.accessed",
+                (self.ttl, time.time()),
+            ).fetchall()
+
+    def _after_write(self, count):
+        # Evict theo LRU mỗi ~100 lần ghi thay vì sau từng lần ghi
+        self._writes += count
+        if self._writes < 100:
+            return
+        self._writes = 0
+        now = time.time()
+        for table in ("queries", "videos"):
+            self._db.execute(f"DELETE FROM {table} WHERE created + ? <= ?", (self.ttl, now))
+            self._db.execute(
+                f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} "
+                f"ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def stats(self):
+        with self._lock:
+            return {"hits": dict(self.hits), "misses": dict(self.misses)}
@@ -0,0 +1,113 @@
+import asyncio
+import logging
+
+import discord
+
+from extract_scheduler import TokenBucket
+
+# Hàng đợi tin nhắn gửi đi theo từng channel:
+#   - debounce: chờ một nhịp rồi mới gửi, tin cùng `key` chỉ giữ bản mới nhất (coalesce)
+#   - "Now Playing" được sửa lại trên một tin nhắn cố định thay vì gửi tin mới
+#   - token bucket theo channel (Discord cho ~5 tin / 5 giây) để không chạm 429
+#   - quá nhiều tin chờ thì bỏ tin cũ nhất
+
+NOW_PLAYING = "now_playing"
+
+
+class _ChannelState:
+    __slots__ = ("channel", "pending", "bucket", "task", "now_playing")
+
+    def __init__(self, channel, rate, burst):
+        self.channel = channel
+        self.pending = []  # [key, embed]
+        self.bucket = TokenBucket(rate, burst)
+        self.task = None
+        self.now_playing = None  # discord.Message đang được sửa
+
+
+class Outbox:
+    def __init__(self, rate=1.0, burst=5, debounce=0.5, max_pending=10):
+        self.rate = rate
+        self.burst = burst
+        self.debounce = debounce
+        self.max_pending = max_pending
+        self.sent = 0
+        self.edited = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.throttled = 0
+        self.failed = 0
+        self._channels = {}
+
+    def send(self, channel, embed, key=None):
+        state = self._channels.get(channel.id)
+        if state is None:
+            state = self._channels[channel.id] = _ChannelState(channel, self.rate, self.burst)
+        state.channel = channel
+        if key is not None:
+            for item in state.pending:
+                if item[0] == key:
+                    item[1] = embed
+                    self.coalesced += 1
+                    return
+        if len(state.pending) >= self.max_pending:
+            state.pending.pop(0)
+            self.dropped += 1
+        state.pending.append([key, embed])
+        if state.task is None or state.task.done():
+            state.task = asyncio.create_task(self._drain(state))
+
+    def now_playing(self, channel, embed):
+        self.send(channel, embed, key=NOW_PLAYING)
+
+    def forget(self, channel_id):
+        """Bỏ tin Now Playing cố định, lần sau sẽ gửi tin mới (vd. khi bot rời voice)."""
+        state = self._channels.get(channel_id)
+        if state is not None:
+            state.now_playing = None
+
+    async def _drain(self, state):
+        await asyncio.sleep(self.debounce)
+        while state.pending:
+            delay = state.bucket.reserve()
+            if delay > 0:
+                self.throttled += 1
+                await asyncio.sleep(delay)
+                # Trong lúc chờ có thể đã có bản mới hơn được coalesce vào
+            key, embed = state.pending.pop(0)
+            try:
+                if key == NOW_PLAYING:
+                    await self._update_now_playing(state, embed)
+                else:
+                    await state.channel.send(embed=embed)
+                    self.sent += 1
+            except discord.HTTPException as e:
+                self.failed += 1
+                logging.warning(f"Failed to send message to channel {state.channel.id}: {e}")
+        if state.now_playing is None and not state.pending:
+            self._channels.pop(state.channel.id, None)
+
+    async def _update_now_playing(self, state, embed):
+        message = state.now_playing
+        # Chỉ sửa khi tin cũ vẫn là tin cuối của channel, nếu không người dùng sẽ không thấy
+        if message is not None and getattr(state.channel, "last_message_id", None) == message.id:
+            try:
+                await message.edit(embed=embed)
+                self.edited += 1
+                return
+            except discord.NotFound:
+                pass
+        state.now_playing = await state.channel.send(embed=embed)
+        self.sent += 1
+
+    def stats(self):
+        return {
+            "channels": len(self._channels),
+            "pending": sum(len(state.pending) for state in list(self._channels.values())),
+            "sent": self.sent,
+            "edited": self.edited,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "throttled": self.throttled,
+            "failed": self.failed,
+        }
@@ -0,0 +1,50 @@
+import time
+
+import discord
+
+# Đồng hồ phát nhạc đếm theo số frame audio thật sự được gửi tới Discord:
+# mỗi lần voice client đọc một frame (20 ms) thì vị trí tăng đúng 20 ms, nên
+# pause, lag hay ffmpeg khởi động chậm đều không làm lệch như khi tính bằng wall clock.
+
+FRAME_SECONDS = discord.opus.Encoder.FRAME_LENGTH / 1000
+JITTER_IGNORE = 1.0  # khoảng cách giữa hai frame dài hơn mức này là pause, không tính jitter
+
+
+class TrackedSource(discord.AudioSource):
+    """Bọc một AudioSource, đếm frame đã đọc. `offset` là vị trí bắt đầu (-ss) của source."""
+
+    def __init__(self, source, offset=0.0):
+        self.source = source
+        self.offset = offset
+        self.frames = 0
+        self.last_read = None  # perf_counter lúc đọc frame gần nhất
+        # Jitter = độ lệch khoảng cách giữa hai lần thread audio đọc frame so với 20 ms
+        self.jitter_total = 0.0
+        self.jitter_max = 0.0
+        self.late_frames = 0   # frame đến trễ hơn cả một frame
+
+    def read(self):
+        data = self.source.read()
+        if data:
+            now = time.perf_counter()
+            if self.last_read is not None and now - self.last_read < JITTER_IGNORE:
+                jitter = abs(now - self.last_read - FRAME_SECONDS)
+                self.jitter_total += jitter
+                self.jitter_max = max(self.jitter_max, jitter)
+                if jitter > FRAME_SECONDS:
+                    self.late_frames += 1
+            self.frames += 1
+            self.last_read = now
+        return data
+
+    def jitter_avg(self):
+        return self.jitter_total / (self.frames - 1) if self.frames > 1 else 0.0
+
+    def is_opus(self):
+        return self.source.is_opus()
+
+    def cleanup(self):
+        self.source.cleanup()
+
+    def position(self):
+        return self.offset + self.frames * FRAME_SECONDS
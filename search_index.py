@@ -0,0 +1,116 @@
+import bisect
+import re
+import time
+from collections import OrderedDict
+
+# Dữ liệu cho autocomplete của /play:
+#   TitleIndex : prefix index trong RAM của các title đã phát / đã tìm, tra bằng bisect
+#   ResultCache: kết quả flat search theo prefix, LRU có TTL
+# Cả hai chỉ được dùng trên event loop nên không cần lock.
+
+MAX_WORDS = 12  # chỉ index các suffix bắt đầu ở 12 từ đầu của title
+
+
+def normalize_title(text):
+    """Chữ thường, bỏ dấu câu: 'Rick Astley - Never Gonna' -> 'rick astley never gonna'."""
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+
+class TitleIndex:
+    """
+    Mỗi title được index theo từng suffix bắt đầu ở đầu một từ, nên gõ "never gonna"
+    vẫn khớp "Rick Astley - Never Gonna Give You Up". Query từ khoá đã từng tìm ra
+    video nào cũng được index về video đó.
+    """
+
+    def __init__(self, max_videos=20000):
+        self.max_videos = max_videos
+        self._keys = []                  # [(key, video_id)] đã sắp xếp
+        self._videos = OrderedDict()     # video_id -> (title, duration, webpage_url, [key])
+
+    def __len__(self):
+        return len(self._videos)
+
+    def load(self, rows):
+        """Nạp lại toàn bộ từ (video_id, title, duration, webpage_url, query), cũ trước mới sau."""
+        self._keys = []
+        self._videos = OrderedDict()
+        for video_id, title, duration, webpage_url, query in rows:
+            self.add(video_id, title, duration, webpage_url, query=query)
+
+    def add(self, video_id, title, duration, webpage_url, query=None):
+        entry = self._videos.get(video_id)
+        if entry is None:
+            words = normalize_title(title).split()
+            keys = [" ".join(words[i:]) for i in range(min(len(words), MAX_WORDS))]
+            entry = self._videos[video_id] = (title, duration, webpage_url, [])
+            self._insert(video_id, entry, keys)
+            if len(self._videos) > self.max_videos:
+                self._evict()
+        else:
+            self._videos.move_to_end(video_id)
+        if query:
+            self._insert(video_id, entry, [normalize_title(query)])
+
+    def _insert(self, video_id, entry, keys):
+        for key in keys:
+            item = (key, video_id)
+            i = bisect.bisect_left(self._keys, item)
+            if key and (i == len(self._keys) or self._keys[i] != item):
+                self._keys.insert(i, item)
+                entry[3].append(key)
+
+    def _evict(self):
+        video_id, entry = self._videos.popitem(last=False)
+        for key in entry[3]:
+            i = bisect.bisect_left(self._keys, (key, video_id))
+            if i < len(self._keys) and self._keys[i] == (key, video_id):
+                del self._keys[i]
+
+    def search(self, text, limit=25):
+        prefix = normalize_title(text)
+        if not prefix:
+            return []
+        results = []
+        seen = set()
+        i = bisect.bisect_left(self._keys, (prefix,))
+        end = min(len(self._keys), i + limit * MAX_WORDS)  # giới hạn số key phải duyệt
+        while i < end and len(results) < limit:
+            key, video_id = self._keys[i]
+            if not key.startswith(prefix):
+                break
+            if video_id not in seen:
+                seen.add(video_id)
+                title, duration, webpage_url, _ = self._videos[video_id]
+                results.append({"id": video_id, "title": title, "duration": duration, "webpage_url": webpage_url})
+            i += 1
+        return results
+
+
+class ResultCache:
+    def __init__(self, max_entries=1024, ttl=600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (hết hạn lúc, kết quả)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, results):
+        self._entries[key] = (time.monotonic() + self.ttl, results)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
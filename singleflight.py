@@ -0,0 +1,60 @@
+import asyncio
+from collections import Counter
+
+# Gộp các lời gọi giống nhau đang chạy đồng thời: caller đầu tiên chạy thật,
+# các caller sau cùng key chỉ chờ chung một future.
+# Caller gấp hơn (priority nhỏ hơn) job đang chờ thì gọi promote(key, priority) để
+# nâng priority của chính job đó (vd. ExtractionScheduler.reprioritise), không chạy lại.
+
+
+class SingleFlight:
+    def __init__(self, promote=None):
+        self.promote = promote
+        self.executions = 0
+        self.absorbed = 0
+        self.promoted = 0
+        self.absorbed_per_call = Counter()  # số caller được gộp -> số lần
+        self._inflight = {}
+        self._waiters = {}
+        self._priorities = {}
+
+    async def do(self, key, factory, priority=None):
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(factory())
+            self._inflight[key] = future
+            self._waiters[key] = 0
+            self._priorities[key] = priority
+            self.executions += 1
+            future.add_done_callback(lambda f: self._finish(key, f))
+        else:
+            self._waiters[key] += 1
+            self.absorbed += 1
+            current = self._priorities[key]
+            if priority is not None and current is not None and priority < current:
+                self._priorities[key] = priority
+                if self.promote is not None and self.promote(key, priority):
+                    self.promoted += 1
+        # shield: một caller bị huỷ (vd. interaction timeout) không huỷ việc của người khác
+        return await asyncio.shield(future)
+
+    def _finish(self, key, future):
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+            del self._priorities[key]
+            self.absorbed_per_call[self._waiters.pop(key)] += 1
+        if not future.cancelled():
+            # tránh "exception was never retrieved" khi mọi caller đã bị huỷ
+            future.exception()
+
+    def inflight(self):
+        return len(self._inflight)
+
+    def stats(self):
+        return {
+            "executions": self.executions,
+            "absorbed": self.absorbed,
+            "promoted": self.promoted,
+            "inflight": len(self._inflight),
+            "absorbed_per_call": dict(self.absorbed_per_call),
+        }
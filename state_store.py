@@ -0,0 +1,104 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Lưu queue / loop mode / bài đang phát của từng guild xuống SQLite theo kiểu
+# write-behind: các lệnh chỉ đánh dấu guild "dirty", một task nền gom lại rồi
+# ghi theo lô trong thread riêng nên event loop không bao giờ chờ đĩa.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS guild_state (
+    guild_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+
+class StateStore:
+    def __init__(self, path, snapshot, flush_interval=2.0, position_interval=10.0):
+        """`snapshot(guild_id)` trả về dict JSON được của guild, hoặc None để xoá."""
+        self.snapshot = snapshot
+        self.flush_interval = flush_interval
+        self.position_interval = position_interval
+        self.writes = 0
+        self.batches = 0
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="state-store")
+        self._task = None
+
+    def mark_dirty(self, guild_id):
+        self._dirty.add(guild_id)
+
+    def load_all(self):
+        with self._lock:
+            rows = self._db.execute("SELECT guild_id, state FROM guild_state").fetchall()
+        states = {}
+        for guild_id, state in rows:
+            try:
+                states[guild_id] = json.loads(state)
+            except ValueError as e:
+                logging.warning(f"Ignoring corrupt saved state for guild {guild_id}: {e}")
+        return states
+
+    def start(self, playing_guilds):
+        """`playing_guilds()` trả về các guild đang phát, được lưu định kỳ để nhớ vị trí."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(playing_guilds))
+
+    async def _run(self, playing_guilds):
+        loop = asyncio.get_running_loop()
+        last_position_save = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if time.monotonic() - last_position_save >= self.position_interval:
+                last_position_save = time.monotonic()
+                self._dirty.update(playing_guilds())
+            batch = self._collect()
+            if batch:
+                try:
+                    await loop.run_in_executor(self._executor, self._write, batch)
+                except Exception as e:
+                    logging.error(f"Failed to persist guild state: {e}")
+
+    def _collect(self):
+        # Snapshot được chụp trên event loop nên luôn nhất quán với queue
+        dirty, self._dirty = self._dirty, set()
+        batch = []
+        for guild_id in dirty:
+            state = self.snapshot(guild_id)
+            batch.append((guild_id, json.dumps(state) if state else None))
+        return batch
+
+    def _write(self, batch):
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute("BEGIN")
+            for guild_id, state in batch:
+                if state is None:
+                    self._db.execute("DELETE FROM guild_state WHERE guild_id = ?", (guild_id,))
+                else:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO guild_state (guild_id, state, updated) VALUES (?, ?, ?)",
+                        (guild_id, state, now),
+                    )
+        self.writes += len(batch)
+        self.batches += 1
+
+    def flush(self):
+        """Ghi đồng bộ mọi thay đổi còn lại, dùng lúc tắt bot."""
+        batch = self._collect()
+        if batch:
+            self._write(batch)
+
+    def stats(self):
+        return {"dirty": len(self._dirty), "writes": self.writes, "batches": self.batches}
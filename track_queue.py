@@ -0,0 +1,112 @@
+import random
+
+# Hàng đợi bài hát của một guild.
+# Dựa trên một list Python với chỉ số đầu hàng (head): popleft là O(1) khấu hao,
+# truy cập theo vị trí là O(1), remove/move theo vị trí chỉ là một lần memmove
+# con trỏ trong C (vài micro giây với hàng nghìn bài) nên nhanh hơn một cây cân
+# bằng viết bằng Python ở mọi kích thước queue thực tế. Shuffle làm tại chỗ.
+
+
+class Track:
+    __slots__ = ("url", "title", "duration", "requester")
+
+    def __init__(self, url, title, duration, requester):
+        self.url = url
+        self.title = title
+        self.duration = duration or 0
+        self.requester = requester
+
+    def __repr__(self):
+        return f"Track({self.title!r}, {self.url!r})"
+
+
+class TrackQueue:
+    __slots__ = ("_items", "_head", "total_duration")
+
+    # Thu gọn list khi phần đã pop ở đầu vượt ngưỡng này và chiếm quá nửa list
+    COMPACT_THRESHOLD = 64
+
+    def __init__(self, tracks=()):
+        self._items = list(tracks)
+        self._head = 0
+        self.total_duration = sum(track.duration for track in self._items)
+
+    def __len__(self):
+        return len(self._items) - self._head
+
+    def __bool__(self):
+        return len(self._items) > self._head
+
+    def __iter__(self):
+        items = self._items
+        for i in range(self._head, len(items)):
+            yield items[i]
+
+    def __getitem__(self, index):
+        return self._items[self._index(index)]
+
+    def _index(self, index):
+        size = len(self)
+        if index < 0:
+            index += size
+        if not 0 <= index < size:
+            raise IndexError("track queue index out of range")
+        return self._head + index
+
+    def iter_range(self, start, stop):
+        """Duyệt các bài ở vị trí [start, stop) mà không copy queue."""
+        items = self._items
+        stop = min(self._head + stop, len(items))
+        for i in range(self._head + max(start, 0), stop):
+            yield items[i]
+
+    def append(self, track):
+        self._items.append(track)
+        self.total_duration += track.duration
+
+    def appendleft(self, track):
+        if self._head:
+            self._head -= 1
+            self._items[self._head] = track
+        else:
+            self._items.insert(0, track)
+        self.total_duration += track.duration
+
+    def popleft(self):
+        if not self:
+            raise IndexError("pop from an empty track queue")
+        items = self._items
+        track = items[self._head]
+        items[self._head] = None
+        self._head += 1
+        if self._head >= self.COMPACT_THRESHOLD and self._head * 2 >= len(items):
+            del items[:self._head]
+            self._head = 0
+        self.total_duration -= track.duration
+        return track
+
+    def pop(self, index):
+        track = self._items.pop(self._index(index))
+        self.total_duration -= track.duration
+        return track
+
+    def move(self, source, destination):
+        """Chuyển bài ở vị trí `source` tới vị trí `destination` (0-based)."""
+        track = self._items.pop(self._index(source))
+        size = len(self)
+        destination = max(0, min(destination if destination >= 0 else destination + size + 1, size))
+        self._items.insert(self._head + destination, track)
+        return track
+
+    def shuffle(self, rng=random):
+        items = self._items
+        head = self._head
+        # Fisher-Yates tại chỗ trên phần còn lại của queue
+        for i in range(len(items) - 1, head, -1):
+            j = rng.randint(head, i)
+            items[i], items[j] = items[j], items[i]
+
+    def clear(self):
+        self._items.clear()
+        self._head = 0
+        self.total_duration = 0
@@ -1,179 +1,810 @@
+import time
+STARTUP_STARTED = time.perf_counter()  # mốc đo time-to-ready, đặt trước mọi import nặng
 import os
+import atexit
 import discord
 from discord.ext import commands
 from discord import app_commands
 from dotenv import load_dotenv
-import yt_dlp
-from collections import deque
 import asyncio
-import random
-import datetime
-import time
+import math
+import json
+import hashlib
+import weakref
+import io
+import queue
 import logging
-import base64
+import logging.handlers
+from urllib.parse import urlparse, parse_qs
 from pathlib import Path
 
-from keep_alive import keep_alive
-
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+from keep_alive import keep_alive, set_health_check, set_diagnostics
+from diagnostics import Diagnostics, PlayTrace
+from metrics import REGISTRY
+from metadata_cache import MetadataCache, normalize_query, youtube_video_id
+from singleflight import SingleFlight
+from audio_cache import AudioCache
+from track_queue import Track, TrackQueue
+from state_store import StateStore
+from outbox import Outbox
+from playback_clock import TrackedSource
+from search_index import TitleIndex, ResultCache
+import control
+from extract_scheduler import (
+    ExtractionScheduler, host_of, PRIORITY_PLAY_NOW, PRIORITY_SEARCH, PRIORITY_AUTOCOMPLETE, PRIORITY_PREFETCH,
+    PRIORITY_BACKGROUND,
+)
+import ytdl
+from ytdl import ydl_options
+
+# Log đi qua queue: event loop và thread audio chỉ đẩy record vào, việc ghi ra
+# stdout (có thể bị chặn khi pipe đầy) do thread của QueueListener làm
+_log_queue = queue.SimpleQueue()
+_log_output = logging.StreamHandler()
+_log_output.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+LOG_LISTENER = logging.handlers.QueueListener(_log_queue, _log_output)
+_log_input = logging.handlers.QueueHandler(_log_queue)
+_log_input.setFormatter(logging.Formatter("%(message)s"))  # phần còn lại do _log_output format
+logging.basicConfig(level=logging.INFO, handlers=[_log_input])
+LOG_LISTENER.start()
+atexit.register(LOG_LISTENER.stop)
 
 load_dotenv()
 TOKEN = os.getenv("DISCORD_TOKEN")
 
-keep_alive()
 
 SONG_QUEUES = {}
 LOOP_STATES = {}
 CURRENT_SONG = {}
-
-# Define ydl_options globally
-ydl_options = {
-    "format": "bestaudio/best",
-    "outtmpl": "%(extractor)s-%(id)s-%(title)s.%(ext)s",
-    "restrictfilenames": True,
-    "noplaylist": True,
-    "default_search": "ytsearch1",
-    "quiet": True,
-    "no_warnings": True,
-    "socket_timeout": 8,
-    "retries": 2,
-    "extractor_retries": 2,
-    "fragment_retries": 2,
-    "sleep_interval": 0.5,
-    "max_sleep_interval": 2,
-    "http_headers": {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-        "Accept": "*/*",
-        "Referer": "https://www.youtube.com/",
-    },
-    "force_ipv4": True,
-    "source_address": "0.0.0.0",
-    "cookiefile": "cookies.txt",
-    "extract_flat": "in_playlist",
-    "cachedir": "/tmp/yt_dlp_cache",
-    "force_generic_extractor": True,
-    "geo_bypass": True,
-    "nocheckcertificate": True,
-    # (tuỳ chọn) giúp yt-dlp đổi client khi cần
-    # "extractor_args": {"youtube": {"player_client": ["web","android","ios"]}},
-}
+PLAYLIST_TASKS = {}
+PREFETCH_TASKS = {}   # guild_id -> task resolve/pre-warm bài kế tiếp
+PREFETCHED = {}       # guild_id -> (webpage_url, source đã mở sẵn ffmpeg)
+PREFETCH_URLS = {}    # guild_id -> webpage_url của bài mà PREFETCH_TASKS đang chuẩn bị
+FINISHED_AT = {}      # guild_id -> perf_counter lúc bài trước kết thúc
+VOICE_CHANNELS = {}   # guild_id -> voice channel id bot đang (hoặc cần) ở trong
+TEXT_CHANNELS = {}    # guild_id -> text channel nhận thông báo "Now Playing"
+RESUME_OFFSETS = {}   # guild_id -> (webpage_url, giây) để phát tiếp bài đang dở
+
+PLAYLIST_RESOLVE_CONCURRENCY = int(os.getenv("PLAYLIST_RESOLVE_CONCURRENCY", "4"))  # resolve nền cùng lúc / guild
+GUILD_RESOLVE_SLOTS = {}  # guild_id -> Semaphore dùng chung cho mọi playlist đang nạp của guild
+
+# Admission control: quota theo guild và bỏ bớt việc khi scheduler quá tải, để một
+# guild nhỏ /play một bài vẫn bắt đầu nhanh dù guild khác đang nạp playlist khổng lồ
+GUILD_MAX_QUEUE = int(os.getenv("GUILD_MAX_QUEUE", "500"))
+QUEUE_FULL_MESSAGE = f"The queue is full ({GUILD_MAX_QUEUE} songs). Skip or remove some songs first."
+GUILD_MAX_PENDING_PLAYS = int(os.getenv("GUILD_MAX_PENDING_PLAYS", "3"))  # /play đang tìm/resolve cùng lúc
+EXTRACT_SHED_DEPTH = int(os.getenv("EXTRACT_SHED_DEPTH", "20"))  # job người dùng đang chờ, từ mức này bắt đầu từ chối
+PLAYS_IN_FLIGHT = {}      # guild_id -> số /play đang xử lý
+PLAYLIST_PROGRESS_INTERVAL = 2.0
+
+METADATA_CACHE = MetadataCache(
+    os.getenv("METADATA_CACHE_PATH", "/tmp/trcmusic_metadata.sqlite3"),
+    max_entries=int(os.getenv("METADATA_CACHE_SIZE", "5000")),
+    ttl=int(os.getenv("METADATA_CACHE_TTL", str(7 * 24 * 3600))),
+)
+# Cache Ogg/Opus cục bộ cho bài hay phát, bật khi có AUDIO_CACHE_DIR
+AUDIO_CACHE = None
+if os.getenv("AUDIO_CACHE_DIR"):
+    AUDIO_CACHE = AudioCache(
+        os.getenv("AUDIO_CACHE_DIR"),
+        ytdl.download_audio,
+        min_plays=int(os.getenv("AUDIO_CACHE_MIN_PLAYS", "3")),
+        max_bytes=int(os.getenv("AUDIO_CACHE_MAX_MB", "2048")) * 1024 * 1024,
+    )
+
+EXTRACT_WAIT_SECONDS = REGISTRY.histogram(
+    "trcmusic_extract_wait_seconds", "Time extraction jobs waited in the queue before a worker ran them, by priority"
+)
+EXTRACT_SCHEDULER = ExtractionScheduler(
+    workers=int(os.getenv("EXTRACT_WORKERS", "4")),
+    use_processes=os.getenv("EXTRACT_POOL", "thread").lower() == "process",
+    host_rate=float(os.getenv("EXTRACT_HOST_RATE", "5")),
+    host_burst=int(os.getenv("EXTRACT_HOST_BURST", "10")),
+    wait_histogram=EXTRACT_WAIT_SECONDS,
+)
+# Nhiều guild cùng /play một bài -> chỉ một lần extract thật; caller gấp hơn nâng priority
+# của job đang chờ đó thay vì chờ sau nó
+EXTRACT_FLIGHTS = SingleFlight(promote=EXTRACT_SCHEDULER.reprioritise)
+
+# Autocomplete cho /play: tra prefix index cục bộ trước, chỉ flat search online khi
+# cục bộ có quá ít gợi ý, sau khi người dùng ngừng gõ, và trong ngân sách thời gian mỗi phím
+TITLE_INDEX = TitleIndex()
+AUTOCOMPLETE_CACHE = ResultCache()
+AUTOCOMPLETE_LATEST = {}       # user_id -> prefix gõ gần nhất, để debounce
+AUTOCOMPLETE_MIN_CHARS = 3
+AUTOCOMPLETE_REMOTE_BELOW = 5  # cục bộ có ít hơn chừng này gợi ý thì mới search online
+AUTOCOMPLETE_RESULTS = 5       # số video lấy về mỗi lần flat search
+AUTOCOMPLETE_DEBOUNCE = float(os.getenv("AUTOCOMPLETE_DEBOUNCE", "0.3"))
+AUTOCOMPLETE_BUDGET = float(os.getenv("AUTOCOMPLETE_BUDGET", "1.5"))  # giây / phím, Discord chỉ chờ 3 giây
+
+# Tin nhắn player gửi vào text channel đi qua outbox: gom/debounce, sửa một tin
+# "Now Playing" cố định và tự giới hạn tốc độ theo channel
+OUTBOX = Outbox(debounce=float(os.getenv("OUTBOX_DEBOUNCE", "0.5")))
+
+# === Metrics, xem ở /metrics trên server keep_alive ===
+STAGE_SECONDS = REGISTRY.histogram(
+    "trcmusic_stage_seconds", "Latency of each playback stage (search, resolve, ffmpeg_spawn, first_audio)"
+)
+TRANSITION_GAP_SECONDS = REGISTRY.histogram(
+    "trcmusic_transition_gap_seconds", "Silence between the end of a track and the start of the next"
+)
+LOOP_LAG_SECONDS = REGISTRY.histogram(
+    "trcmusic_event_loop_lag_seconds", "How late the event loop woke up a periodic probe",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+STREAM_CACHE_LOOKUPS = REGISTRY.counter("trcmusic_stream_cache_lookups_total", "Stream URL cache lookups by result")
+TRACK_RESULTS = REGISTRY.counter("trcmusic_tracks_total", "Tracks handled by the player by result")
+AUTOCOMPLETE_SECONDS = REGISTRY.histogram(
+    "trcmusic_autocomplete_seconds", "Latency of /play autocomplete responses by where the suggestions came from"
+)
+ADMISSION_REJECTED = REGISTRY.counter("trcmusic_play_rejected_total", "/play requests turned away by reason")
+VOICE_RECONNECTS = REGISTRY.counter("trcmusic_voice_reconnects_total", "Voice reconnects made by the supervisor")
+STARTUP = {}  # phase -> giây tính từ STARTUP_STARTED (init, ready) hoặc thời lượng (command_sync)
+LOOP_LAG_INTERVAL = 0.5
+LOOP_LAG = {"last": 0.0}
+HEALTH_MAX_LATENCY = 10.0  # giây, heartbeat gateway chậm hơn mức này coi như không khoẻ
+PLAY_TRACES = {}             # guild_id -> PlayTrace của /play đang chờ player phát tiếng đầu tiên
+AFTER_PLAY_DELAY_SECONDS = REGISTRY.histogram(
+    "trcmusic_after_play_delay_seconds", "Delay between a track ending on the audio thread and the event loop noticing",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+DIAGNOSTICS = Diagnostics(
+    sample_interval=float(os.getenv("DIAGNOSTICS_SAMPLE_MS", "10")) / 1000,
+    slow_threshold=float(os.getenv("SLOW_CALLBACK_MS", "100")) / 1000,
+)
+FFMPEG_SOURCES = weakref.WeakSet()  # mọi source ffmpeg đã mở, để đếm process còn sống
 
 ffmpeg_options = {
     "before_options": "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 -nostdin",
-    "options": "-vn -c:a libopus -b:a 96k -bufsize 64k -frame_duration 20 -application lowdelay",
+    "options": "-vn",
 }
 
-# === NEW: helper gắn cookies vào ydl options (dùng chung cho search & resolve) ===
-def prepare_ydl_opts(base_opts: dict) -> dict:
-    opts = dict(base_opts)  # copy để không đụng bản gốc
-    cookies_path = Path(opts.get("cookiefile", "cookies.txt"))
-    cookies_b64 = os.getenv("YTDLP_COOKIES")
-
-    if cookies_b64:
-        try:
-            cookies_path.write_bytes(base64.b64decode(cookies_b64))
-            opts["cookiefile"] = str(cookies_path)
-            logging.info(f"Loaded cookies from env to {cookies_path}")
-        except Exception as e:
-            logging.warning(f"Failed to write cookies from env: {e}")
-    elif cookies_path.exists():
-        opts["cookiefile"] = str(cookies_path)
-        logging.info(f"Using existing cookies file at {cookies_path}")
-    else:
-        logging.warning("Cookies file not found and YTDLP_COOKIES is empty. YouTube may require login.")
-
-    return opts
-# === END NEW ===
-
-async def search_ytdlp_async(query, ydl_opts):
-    loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(None, lambda: _extract(query, ydl_opts))
-
-def _extract(query, ydl_opts):
-    # === CHANGED: dùng helper cookies chung ===
-    opts = prepare_ydl_opts(ydl_opts)
-    with yt_dlp.YoutubeDL(opts) as ydl:
-        try:
-            return ydl.extract_info(query, download=False)
-        except Exception as e:
-            logging.error(f"yt-dlp extraction failed: {e}")
-            raise
+# Playback mode:
+#   "opus" (mặc định) - FFmpegOpusAudio. Stream webm/opus của YouTube được remux
+#       thẳng sang Ogg (-c:a copy): ffmpeg không decode/encode, bot chỉ đọc packet
+#       Opus có sẵn và gửi đi. Nguồn không phải Opus (m4a/aac...) được ffmpeg encode
+#       libopus trong process con, không đụng tới GIL của bot.
+#   "pcm" - FFmpegPCMAudio như trước: ffmpeg decode ra s16le, rồi discord.py encode
+#       lại từng frame 20 ms sang Opus trong process bot (libopus qua ctypes).
+#
+# Chi phí CPU mỗi stream, % của một core (bot + process ffmpeg), đo bằng
+#   [PLAYBACK_MODE=pcm] python benchmark.py --source ffmpeg [--acodec aac] --guilds 10 --songs 2 --track-seconds 15
+# trên 1 vCPU Xeon, ffmpeg 7.0.2 static (libopus 1.3.1), discord.py encode bằng libopus 1.6.1,
+# hai lần chạy (seed 1 và 2):
+#   opus + copy  : 0.40-0.48% - chỉ demux/remux, không decode hay encode.
+#   opus + encode: 9.0-9.7%   - decode + encode libopus (-fec, packet_loss 15) trong ffmpeg.
+#   pcm          : 3.4-3.6%   - decode trong ffmpeg (~0.4%) + encode trong bot (~2%, giữ GIL)
+#                  + copy 3.8 KB PCM mỗi frame qua pipe; RSS gấp đôi (~314 KB/guild so với ~150).
+# Encode nằm ở đâu thì chi phí theo bản libopus ở đó: cùng 60 s audio, libopus 1.3.1 của ffmpeg
+# tốn ~7.5% còn 1.6.1 trong bot ~2%, nên "pcm rẻ hơn opus + encode" ở trên là do khác bản
+# libopus, không phải do mode. Copy luôn rẻ nhất; pcm vẫn là mode duy nhất encode trên GIL của bot.
+PLAYBACK_MODE = os.getenv("PLAYBACK_MODE", "opus").lower()
+OPUS_BITRATE = 96  # kbps, chỉ dùng khi phải encode
+# Mở sẵn ffmpeg cho bài kế tiếp khi bài hiện tại còn chừng này giây (0 = chỉ resolve trước)
+PREWARM_SECONDS = float(os.getenv("PREWARM_SECONDS", "10"))
+
+async def search_ytdlp_async(query, ydl_opts, priority=PRIORITY_SEARCH, guild_id=None):
+    with STAGE_SECONDS.time(stage="search"):
+        key = ("search", normalize_query(query))
+        return await EXTRACT_FLIGHTS.do(
+            key,
+            lambda: EXTRACT_SCHEDULER.submit(ytdl.extract, query, ydl_opts, priority=priority, host=host_of(query),
+                                             owner=guild_id, key=key),
+            priority=priority,
+        )
 
 # === NEW: helper resolve URL stream trực tiếp cho 1 entry (kể cả kênh/playlist/flat) ===
-async def resolve_stream_url_async(entry):
-    loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(None, lambda: _resolve_stream_url(entry))
-
-def _resolve_stream_url(entry):
-    """
-    Trả về tuple (stream_url, title, duration) đã được yt_dlp resolve thành URL audio trực tiếp.
-    Nếu entry là kênh/playlist/flat entry -> re-extract bằng extract_flat=False để lấy formats thật.
-    """
+async def resolve_stream_url_async(entry, priority=PRIORITY_PLAY_NOW, guild_id=None):
     target = entry.get("webpage_url") or entry.get("url")
-    if not target:
-        return None
+    with STAGE_SECONDS.time(stage="resolve"):
+        key = ("resolve", youtube_video_id(target) or target)
+        resolved = await EXTRACT_FLIGHTS.do(
+            key,
+            lambda: EXTRACT_SCHEDULER.submit(ytdl.resolve_stream_url, entry, priority=priority, host=host_of(target),
+                                             owner=guild_id, key=key),
+            priority=priority,
+        )
+    if resolved:
+        METADATA_CACHE.put_videos([resolved])
+        remember_titles([resolved])
+    return resolved
 
-    local_opts = dict(ydl_options)
-    local_opts.update({
-        "extract_flat": False,            # cần full info + formats
-        "noplaylist": True,               # chỉ lấy 1 video
-        "quiet": True,
-        "force_generic_extractor": False, # dùng extractor gốc YouTube
-    })
-    # === CHANGED: gắn cookies trước khi gọi yt-dlp ===
-    local_opts = prepare_ydl_opts(local_opts)
+def remember_titles(tracks, query=None):
+    """Đưa title của các video YouTube vào prefix index của autocomplete."""
+    for track in tracks:
+        if not track or not track.get("title"):
+            continue
+        webpage_url = track.get("webpage_url") or track.get("url")
+        video_id = youtube_video_id(webpage_url)
+        if video_id:
+            TITLE_INDEX.add(video_id, track["title"], track.get("duration") or 0, webpage_url, query=query)
 
+async def _flat_search(key):
     try:
-        with yt_dlp.YoutubeDL(local_opts) as ydl:
-            info = ydl.extract_info(target, download=False)
+        results = await EXTRACT_FLIGHTS.do(
+            ("flat", key),
+            lambda: EXTRACT_SCHEDULER.submit(ytdl.search_flat, key, AUTOCOMPLETE_RESULTS,
+                                             priority=PRIORITY_AUTOCOMPLETE, host=host_of(key)),
+            priority=PRIORITY_AUTOCOMPLETE,
+        )
     except Exception as e:
-        logging.error(f"Resolve stream failed for target={target}: {e}")
+        logging.warning(f"Autocomplete search failed for '{key}': {e}")
+        return []
+    METADATA_CACHE.put_videos(results)
+    remember_titles(results)
+    AUTOCOMPLETE_CACHE.put(key, results)
+    return results
+
+# Stream URL của googlevideo hết hạn sau vài giờ, nên queue chỉ giữ webpage URL
+# và URL phát được resolve ngay trước khi phát, cache theo tham số "expire".
+STREAM_CACHE = {}              # webpage_url -> (stream_url, acodec, expires_at)
+STREAM_CACHE_MAX = 2048
+STREAM_URL_TTL = 3600          # dùng khi URL không có tham số expire
+STREAM_URL_EXPIRY_MARGIN = 300 # refresh sớm trước khi URL thật sự hết hạn
+
+def _stream_url_expiry(stream_url):
+    parsed = urlparse(stream_url)
+    expire = parse_qs(parsed.query).get("expire")
+    if not expire and "/expire/" in parsed.path:
+        expire = [parsed.path.split("/expire/", 1)[1].split("/", 1)[0]]
+    try:
+        if expire:
+            return int(expire[0]) - STREAM_URL_EXPIRY_MARGIN
+    except ValueError:
+        pass
+    return time.time() + STREAM_URL_TTL
+
+def cache_stream_url(webpage_url, stream_url, acodec=None):
+    STREAM_CACHE[webpage_url] = (stream_url, acodec, _stream_url_expiry(stream_url))
+    if len(STREAM_CACHE) > STREAM_CACHE_MAX:
+        now = time.time()
+        for key in [k for k, (_, _, expires_at) in STREAM_CACHE.items() if expires_at <= now]:
+            del STREAM_CACHE[key]
+        while len(STREAM_CACHE) > STREAM_CACHE_MAX:
+            del STREAM_CACHE[next(iter(STREAM_CACHE))]
+
+async def get_stream_url_async(webpage_url, priority=PRIORITY_PLAY_NOW, guild_id=None):
+    """Trả về (stream_url, acodec), resolve lại nếu URL trong cache đã cũ."""
+    cached = STREAM_CACHE.get(webpage_url)
+    if cached and cached[2] > time.time():
+        STREAM_CACHE_LOOKUPS.inc(result="hit")
+        return cached[0], cached[1]
+    STREAM_CACHE_LOOKUPS.inc(result="expired" if cached else "miss")
+
+    resolved = await resolve_stream_url_async({"webpage_url": webpage_url}, priority=priority, guild_id=guild_id)
+    if not resolved:
+        STREAM_CACHE.pop(webpage_url, None)
         return None
-
-    # Nếu là list/playlist/channel -> chọn phần tử đầu là video và re-extract nếu cần
-    if isinstance(info, dict) and "entries" in info and info["entries"]:
-        for e in info["entries"]:
-            if not e:
-                continue
-            sub_target = e.get("webpage_url") or e.get("url")
-            if not sub_target:
-                continue
-            try:
-                with yt_dlp.YoutubeDL(local_opts) as ydl2:
-                    e2 = ydl2.extract_info(sub_target, download=False)
-                    if e2 and e2.get("url"):
-                        return (e2["url"], e2.get("title", "Untitled"), e2.get("duration", 0))
-            except Exception as ex2:
-                logging.warning(f"Second-stage resolve failed: {ex2}")
-                continue
+    cache_stream_url(webpage_url, resolved["url"], resolved["acodec"])
+    return resolved["url"], resolved["acodec"]
+
+def _ffmpeg_kwargs(start=0, local=False):
+    before_options = "-nostdin" if local else ffmpeg_options["before_options"]
+    if start > 0:
+        before_options = f"-ss {start:.2f} {before_options}"
+    return {"before_options": before_options, "options": ffmpeg_options["options"]}
+
+def _track_ffmpeg(source):
+    FFMPEG_SOURCES.add(source)
+    return source
+
+def ffmpeg_process_count():
+    count = 0
+    for source in list(FFMPEG_SOURCES):
+        process = getattr(source, "_process", None)
+        if process and process.poll() is None:
+            count += 1
+    return count
+
+def create_local_audio_source(path, start=0):
+    # File trong audio cache luôn là Ogg/Opus nên không cần reconnect hay encode
+    if PLAYBACK_MODE == "pcm":
+        return _track_ffmpeg(discord.FFmpegPCMAudio(str(path), **_ffmpeg_kwargs(start, local=True)))
+    return _track_ffmpeg(discord.FFmpegOpusAudio(str(path), codec="copy", **_ffmpeg_kwargs(start, local=True)))
+
+def cached_audio_path(webpage_url):
+    if AUDIO_CACHE is None:
+        return None
+    return AUDIO_CACHE.lookup(youtube_video_id(webpage_url))
+
+async def create_audio_source(stream_url, acodec=None, start=0):
+    options = _ffmpeg_kwargs(start)
+    with STAGE_SECONDS.time(stage="ffmpeg_spawn"):
+        if PLAYBACK_MODE == "pcm":
+            return _track_ffmpeg(discord.FFmpegPCMAudio(stream_url, **options))
+        if acodec and acodec != "none":
+            codec = "copy" if acodec.startswith("opus") else None
+            return _track_ffmpeg(discord.FFmpegOpusAudio(stream_url, bitrate=OPUS_BITRATE, codec=codec, **options))
+        # yt-dlp không cho biết codec -> probe bằng ffprobe rồi mới quyết định copy hay encode
+        return _track_ffmpeg(await discord.FFmpegOpusAudio.from_probe(stream_url, **options))
+
+def current_position(guild_id):
+    """Vị trí trong bài đang phát, đếm theo số frame audio thật sự đã gửi đi."""
+    player = PLAYERS.get(guild_id)
+    if player is not None and player.current is not None:
+        return player.position()
+    # Player đã dừng giữa bài (tắt bot, voice rớt): dùng vị trí nó để lại để phát tiếp
+    song = CURRENT_SONG.get(guild_id)
+    resume = RESUME_OFFSETS.get(guild_id)
+    if song and resume and resume[0] == song["url"]:
+        return resume[1]
+    return 0.0
+
+def parse_timestamp(text):
+    """'90', '1:30' hoặc '1:02:03' -> số giây. Raise ValueError nếu sai định dạng."""
+    parts = text.strip().split(":")
+    if not 1 <= len(parts) <= 3:
+        raise ValueError(text)
+    seconds = 0.0
+    for part in parts:
+        value = float(part)
+        if value < 0 or not math.isfinite(value):
+            raise ValueError(text)
+        seconds = seconds * 60 + value
+    return seconds
+
+def snapshot_guild(guild_id):
+    queue = SONG_QUEUES.get(guild_id)
+    song = CURRENT_SONG.get(guild_id)
+    if not queue and not song and guild_id not in VOICE_CHANNELS:
         return None
+    state = {
+        "loop": LOOP_STATES.get(guild_id, "off"),
+        "queue": [[t.url, t.title, t.duration, t.requester] for t in queue or ()],
+        "voice_channel_id": VOICE_CHANNELS.get(guild_id),
+        "text_channel_id": TEXT_CHANNELS.get(guild_id),
+        "current": None,
+        "resume": None,
+    }
+    resume = RESUME_OFFSETS.get(guild_id)
+    if not song and resume and queue and queue[0].url == resume[0]:
+        # Bài dở đã được đưa lại đầu queue (voice rớt), chỉ cần nhớ vị trí
+        state["resume"] = {"url": resume[0], "position": resume[1]}
+    if song:
+        state["current"] = {
+            "url": song["url"],
+            "title": song["title"],
+            "duration": song["duration"],
+            "requester": song["requester"],
+            "position": current_position(guild_id),
+        }
+    return state
+
+STATE_STORE = StateStore(os.getenv("STATE_DB_PATH", "/tmp/trcmusic_state.sqlite3"), snapshot_guild)
+RESTORED = False
+
+def _flush_state_on_exit():
+    for guild_id in list(CURRENT_SONG):
+        STATE_STORE.mark_dirty(guild_id)
+    STATE_STORE.flush()
+
+atexit.register(_flush_state_on_exit)
+
+async def restore_guild_states():
+    """Khôi phục queue/loop mode sau khi restart và phát tiếp bài đang dở."""
+    for guild_id, state in STATE_STORE.load_all().items():
+        if not owns_guild(guild_id):
+            continue  # guild của shard khác, worker kia sẽ khôi phục
+        guild = bot.get_guild(int(guild_id))
+        if guild is None:
+            continue
+
+        loop_mode = state.get("loop", "off")
+        queue = TrackQueue(Track(*item) for item in state.get("queue", []))
+        current = state.get("current")
+        if current:
+            # Bài đang phát đã được loop "song"/"queue" đưa lại vào queue lúc bắt đầu
+            if loop_mode == "song" and queue and queue[0].url == current["url"]:
+                queue.popleft()
+            elif loop_mode == "queue" and queue and queue[-1].url == current["url"]:
+                queue.pop(-1)
+            queue.appendleft(Track(current["url"], current["title"], current["duration"], current["requester"]))
+            RESUME_OFFSETS[guild_id] = (current["url"], current.get("position", 0))
+        elif state.get("resume"):
+            RESUME_OFFSETS[guild_id] = (state["resume"]["url"], state["resume"]["position"])
+
+        SONG_QUEUES[guild_id] = queue
+        LOOP_STATES[guild_id] = loop_mode
+        logging.info(f"Restored {len(queue)} songs for guild {guild_id}")
+
+        voice_channel = guild.get_channel(state.get("voice_channel_id") or 0)
+        text_channel = guild.get_channel(state.get("text_channel_id") or 0)
+        if not queue or voice_channel is None or text_channel is None:
+            continue
+        try:
+            voice_client = guild.voice_client or await voice_channel.connect()
+        except Exception as e:
+            logging.warning(f"Failed to rejoin voice for guild {guild_id}: {e}")
+            continue
+        VOICE_CHANNELS[guild_id] = voice_channel.id
+        await play_next_song(voice_client, guild_id, text_channel)
+
+async def monitor_loop_lag():
+    """Đo độ trễ event loop: sleep một khoảng cố định rồi xem bị đánh thức muộn bao lâu."""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, time.perf_counter() - started - LOOP_LAG_INTERVAL)
+        LOOP_LAG["last"] = lag
+        LOOP_LAG_SECONDS.observe(lag)
+        if lag > 0.25:
+            logging.warning(f"Event loop lagged {lag * 1000:.0f} ms")
+
+def collect_metrics():
+    # Chạy trên thread của Flask nên chỉ đọc, và copy dict trước khi duyệt
+    players = list(PLAYERS.values())
+    queues = list(SONG_QUEUES.items())
+    scheduler = EXTRACT_SCHEDULER.stats()
+    flights = EXTRACT_FLIGHTS.stats()
+    metadata = METADATA_CACHE.stats()
+    outbox = OUTBOX.stats()
+    autocomplete = AUTOCOMPLETE_CACHE.stats()
+    jitter = frame_jitter()
+    player_states = {}
+    for player in players:
+        state = player.status()
+        player_states[state] = player_states.get(state, 0) + 1
+
+    families = [
+        ("trcmusic_gateway_latency_seconds", "gauge", "Discord gateway heartbeat latency",
+         [({}, bot.latency if math.isfinite(bot.latency) else -1)]),
+        ("trcmusic_shard_latency_seconds", "gauge", "Gateway heartbeat latency per shard",
+         [({"shard": shard_id}, shard.latency) for shard_id, shard in list(getattr(bot, "shards", {}).items())
+          if math.isfinite(shard.latency)]),
+        ("trcmusic_voice_clients", "gauge", "Connected voice clients", [({}, len(bot.voice_clients))]),
+        ("trcmusic_players", "gauge", "Guild players by state",
+         [({"state": state}, count) for state, count in player_states.items()]),
+        ("trcmusic_queue_length", "gauge", "Songs waiting in each guild queue",
+         [({"guild": guild_id}, len(queue)) for guild_id, queue in queues]),
+        ("trcmusic_queue_duration_seconds", "gauge", "Total duration of each guild queue",
+         [({"guild": guild_id}, queue.total_duration) for guild_id, queue in queues]),
+        ("trcmusic_ffmpeg_processes", "gauge", "Running ffmpeg processes", [({}, ffmpeg_process_count())]),
+        ("trcmusic_event_loop_lag_last_seconds", "gauge", "Most recent event loop lag sample",
+         [({}, LOOP_LAG["last"])]),
+        ("trcmusic_frame_jitter_avg_seconds", "gauge", "Average audio frame send jitter of the current track per guild",
+         [({"guild": guild_id}, stats["avg"]) for guild_id, stats in jitter.items()]),
+        ("trcmusic_frame_jitter_max_seconds", "gauge", "Worst audio frame send jitter of the current track per guild",
+         [({"guild": guild_id}, stats["max"]) for guild_id, stats in jitter.items()]),
+        ("trcmusic_late_frames", "gauge", "Audio frames of the current track sent more than a frame late per guild",
+         [({"guild": guild_id}, stats["late_frames"]) for guild_id, stats in jitter.items()]),
+        ("trcmusic_slow_callbacks", "gauge", "Event loop stalls recorded by diagnostics mode",
+         [({}, len(DIAGNOSTICS.slow_events))]),
+        ("trcmusic_extract_queue_depth", "gauge", "Extraction jobs waiting for a worker",
+         [({}, scheduler["queue_depth"])]),
+        ("trcmusic_extract_running", "gauge", "Extraction jobs currently running", [({}, scheduler["running"])]),
+        ("trcmusic_extract_foreground_waiting", "gauge", "Extraction jobs waiting that a user is waiting on",
+         [({}, EXTRACT_SCHEDULER.waiting(PRIORITY_SEARCH))]),
+        ("trcmusic_plays_in_flight", "gauge", "/play commands being looked up per guild",
+         [({"guild": guild_id}, count) for guild_id, count in list(PLAYS_IN_FLIGHT.items())]),
+        ("trcmusic_extract_jobs_total", "counter", "Extraction jobs by result",
+         [({"result": "completed"}, scheduler["completed"]), ({"result": "failed"}, scheduler["failed"]),
+          ({"result": "throttled"}, scheduler["throttled"])]),
+        ("trcmusic_extract_wait_max_seconds", "gauge", "Longest time a job waited in the extraction queue",
+         [({}, scheduler["wait_max"])]),
+        ("trcmusic_singleflight_total", "counter", "Extraction calls executed vs absorbed by an in-flight call",
+         [({"result": "executed"}, flights["executions"]), ({"result": "absorbed"}, flights["absorbed"])]),
+        ("trcmusic_singleflight_absorbed_per_call", "counter",
+         "Finished extractions by how many extra callers shared their result",
+         [({"absorbed": str(absorbed)}, count) for absorbed, count in sorted(flights["absorbed_per_call"].items())]),
+        ("trcmusic_singleflight_promoted_total", "counter",
+         "Queued extractions moved up to the priority of a more urgent caller that joined them", [({}, flights["promoted"])]),
+        ("trcmusic_metadata_cache_lookups_total", "counter", "Metadata cache lookups by kind and result",
+         [({"kind": kind, "result": "hit"}, count) for kind, count in metadata["hits"].items()]
+         + [({"kind": kind, "result": "miss"}, count) for kind, count in metadata["misses"].items()]),
+        ("trcmusic_outbox_messages_total", "counter", "Outbound player messages by outcome",
+         [({"result": key}, outbox[key]) for key in ("sent", "edited", "coalesced", "dropped", "throttled", "failed")]),
+        ("trcmusic_outbox_pending", "gauge", "Player messages waiting to be sent", [({}, outbox["pending"])]),
+        ("trcmusic_startup_seconds", "gauge", "Startup timings: init and ready since process start, command sync duration",
+         [({"phase": phase}, seconds) for phase, seconds in list(STARTUP.items())]),
+        ("trcmusic_stream_cache_entries", "gauge", "Cached stream URLs", [({}, len(STREAM_CACHE))]),
+        ("trcmusic_autocomplete_index_videos", "gauge", "Videos in the autocomplete title index", [({}, len(TITLE_INDEX))]),
+        ("trcmusic_autocomplete_cache_lookups_total", "counter", "Autocomplete search cache lookups by result",
+         [({"result": "hit"}, autocomplete["hits"]), ({"result": "miss"}, autocomplete["misses"])]),
+    ]
+    if AUDIO_CACHE is not None:
+        audio = AUDIO_CACHE.stats()
+        families.append(("trcmusic_audio_cache_lookups_total", "counter", "Audio cache lookups by result",
+                         [({"result": "hit"}, audio["hits"]), ({"result": "miss"}, audio["misses"])]))
+        families.append(("trcmusic_audio_cache_bytes", "gauge", "Bytes of audio on disk", [({}, audio["bytes"])]))
+    return families
+
+def health_status():
+    """Trả về (ok, chi tiết) cho /healthz: gateway phải sẵn sàng, voice bị rớt thì báo degraded."""
+    latency = bot.latency
+    gateway_ok = bot.is_ready() and not bot.is_closed() and math.isfinite(latency) and latency < HEALTH_MAX_LATENCY
+    voice_down = [
+        player.guild_id for player in list(PLAYERS.values())
+        if player.is_busy() and not player.voice_client.is_connected()
+    ]
+    shards_down = [shard_id for shard_id, shard in list(getattr(bot, "shards", {}).items()) if shard.is_closed()]
+    if not gateway_ok:
+        status = "down"
+    elif voice_down or shards_down:
+        status = "degraded"
+    else:
+        status = "ok"
+    return gateway_ok, {
+        "status": status,
+        "gateway": {
+            "ready": bot.is_ready(),
+            "closed": bot.is_closed(),
+            "latency": latency if math.isfinite(latency) else None,
+            "shards_down": shards_down,
+        },
+        "voice": {
+            "connected": sum(1 for vc in list(bot.voice_clients) if vc.is_connected()),
+            "players": len(PLAYERS),
+            "disconnected_guilds": voice_down,
+        },
+        "loop_lag": LOOP_LAG["last"],
+    }
 
-    # Trường hợp single video đã có stream URL
-    if info and info.get("url"):
-        return (info["url"], info.get("title", "Untitled"), info.get("duration", 0))
+def finish_trace(trace):
+    DIAGNOSTICS.record_play(trace)
+    if DIAGNOSTICS.enabled:
+        logging.info(f"/play trace for guild {trace.guild_id}: {trace.describe()} (total {trace.total() * 1000:.0f}ms)")
+
+def frame_jitter():
+    """guild_id -> jitter của bài đang phát, đo trên thread audio (xem playback_clock)."""
+    stats = {}
+    for player in list(PLAYERS.values()):
+        source = player.source
+        if source is not None and source.frames > 1:
+            stats[player.guild_id] = {
+                "avg": source.jitter_avg(),
+                "max": source.jitter_max,
+                "late_frames": source.late_frames,
+                "frames": source.frames,
+            }
+    return stats
+
+def diagnostics_profile(slow_only):
+    if not DIAGNOSTICS.enabled and not DIAGNOSTICS.samples:
+        return None
+    return DIAGNOSTICS.folded(slow_only=slow_only)
+
+def diagnostics_report():
+    # Chạy được cả trên thread của Flask: chỉ đọc và copy trước khi duyệt
+    return {
+        "enabled": DIAGNOSTICS.enabled,
+        "since": DIAGNOSTICS.started_at,
+        "loop_lag": LOOP_LAG["last"],
+        "slow_callbacks": [
+            {"at": at, "seconds": round(seconds, 3), "stack": stack.split(";")[-8:]}
+            for at, seconds, stack in list(DIAGNOSTICS.slow_events)[-20:]
+        ],
+        "frame_jitter": frame_jitter(),
+        "plays": [
+            {"guild": trace.guild_id, "total": round(trace.total(), 3),
+             "stages": {stage: round(seconds, 3) for stage, seconds in trace.stages}}
+            for trace in list(DIAGNOSTICS.plays)[-20:]
+        ],
+        "extraction": EXTRACT_SCHEDULER.stats(),
+        "samples": sum(DIAGNOSTICS.samples.values()),
+    }
 
-    return None
-# === END NEW ===
+REGISTRY.add_collector(collect_metrics)
+set_health_check(health_status)
+set_diagnostics(diagnostics_profile, diagnostics_report)
 
 intents = discord.Intents.default()
 intents.message_content = True
 
-bot = commands.Bot(command_prefix="r", intents=intents)
+# Sharding: launcher.py chia dải shard cho nhiều worker process và đặt SHARD_COUNT /
+# SHARD_IDS cho từng process. SHARD_COUNT=auto chạy mọi shard trong một process.
+SHARD_COUNT = os.getenv("SHARD_COUNT")
+SHARD_IDS = [int(s) for s in os.getenv("SHARD_IDS", "").split(",") if s.strip()] or None
+CONTROL_SOCKET = os.getenv("CONTROL_SOCKET")  # Unix socket để launcher hỏi trạng thái / điều khiển
+
+if SHARD_COUNT:
+    bot = commands.AutoShardedBot(
+        command_prefix="r",
+        intents=intents,
+        shard_count=None if SHARD_COUNT == "auto" else int(SHARD_COUNT),
+        shard_ids=SHARD_IDS,
+    )
+else:
+    bot = commands.Bot(command_prefix="r", intents=intents)
+
+def shard_of(guild_id):
+    return (int(guild_id) >> 22) % (bot.shard_count or 1)
+
+def owns_guild(guild_id):
+    """State của mỗi guild chỉ thuộc về process đang giữ shard của guild đó."""
+    shard_ids = getattr(bot, "shard_ids", None)
+    return shard_ids is None or shard_of(guild_id) in shard_ids
+
+async def control_status():
+    shards = {}
+    for shard_id, shard in getattr(bot, "shards", {}).items():
+        shards[shard_id] = {
+            "latency": shard.latency if math.isfinite(shard.latency) else None,
+            "closed": shard.is_closed(),
+        }
+    return {
+        "pid": os.getpid(),
+        "ready": bot.is_ready(),
+        "shard_count": bot.shard_count,
+        "shard_ids": getattr(bot, "shard_ids", None),
+        "shards": shards,
+        "guilds": len(bot.guilds),
+        "voice_clients": len(bot.voice_clients),
+        "players": len(PLAYERS),
+        "queued": sum(len(queue) for queue in SONG_QUEUES.values()),
+        "loop_lag": LOOP_LAG["last"],
+        "health": health_status()[1]["status"],
+    }
+
+async def control_reconnect_shard(shard_id):
+    shard = bot.get_shard(int(shard_id)) if hasattr(bot, "get_shard") else None
+    if shard is None:
+        raise ValueError(f"shard {shard_id} is not run by this process")
+    logging.info(f"Reconnecting shard {shard_id} on request from the control channel")
+    await shard.reconnect()
+    return {"shard_id": int(shard_id)}
+
+async def control_shutdown():
+    logging.info("Shutting down on request from the control channel")
+    # Đợi một chút để kịp trả lời launcher trước khi đóng kết nối
+    asyncio.get_running_loop().call_later(0.5, lambda: asyncio.ensure_future(bot.close()))
+    return {"pid": os.getpid()}
+
+CONTROL_HANDLERS = {
+    "status": control_status,
+    "reconnect_shard": control_reconnect_shard,
+    "shutdown": control_shutdown,
+}
 
 @bot.event
 async def on_ready():
-    SONG_QUEUES.clear()
-    LOOP_STATES.clear()
-    CURRENT_SONG.clear()
+    global RESTORED
+    if "ready" not in STARTUP:
+        STARTUP["ready"] = time.perf_counter() - STARTUP_STARTED
+        logging.info(f"Time to ready: {STARTUP['ready']:.2f}s (init {STARTUP.get('init', 0):.2f}s)")
+    # Command tree là global: khi chạy nhiều worker chỉ process giữ shard 0 sync
+    if owns_guild(0):
+        try:
+            await sync_commands_if_changed()
+        except discord.HTTPException as e:
+            logging.error(f"Failed to sync command tree: {e}")
+    logging.info(f"{bot.user} is online! (shards {getattr(bot, 'shard_ids', None) or 'all'})")
+    # on_ready chạy lại mỗi lần reconnect gateway, chỉ khôi phục state lần đầu
+    if not RESTORED:
+        RESTORED = True
+        if CONTROL_SOCKET:
+            await control.serve(CONTROL_SOCKET, CONTROL_HANDLERS)
+        STATE_STORE.start(lambda: list(CURRENT_SONG))
+        asyncio.create_task(monitor_loop_lag())
+        asyncio.create_task(supervise_voice())
+        await restore_guild_states()
+
+async def _setup_hook():
+    # Chạy trước khi login/kết nối gateway: yt_dlp được import và các instance
+    # YoutubeDL được khởi tạo trong nền song song với handshake, /play đầu tiên không phải chờ
+    if os.getenv("DIAGNOSTICS") == "1":
+        DIAGNOSTICS.start(asyncio.get_running_loop())
+        logging.info("Diagnostics mode is on")
+    asyncio.create_task(EXTRACT_SCHEDULER.submit(ytdl.warm_up, priority=PRIORITY_BACKGROUND))
+    TITLE_INDEX.load(await asyncio.to_thread(METADATA_CACHE.search_terms))
+    logging.info(f"Loaded {len(TITLE_INDEX)} titles into the autocomplete index")
+
+bot.setup_hook = _setup_hook
+
+# Sync command tree là API global bị rate limit, chỉ gọi khi định nghĩa lệnh thật sự đổi
+COMMAND_HASH_PATH = os.getenv("COMMAND_HASH_PATH", "/tmp/trcmusic_commands.json")
+
+def command_tree_hash():
+    payload = [command.to_dict(bot.tree) for command in bot.tree.get_commands()]
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+async def sync_commands_if_changed():
+    digest = command_tree_hash()
+    key = str(bot.application_id)
+    path = Path(COMMAND_HASH_PATH)
+    try:
+        saved = json.loads(path.read_text())
+    except (OSError, ValueError):
+        saved = {}
+    if saved.get(key) == digest and os.getenv("FORCE_COMMAND_SYNC") != "1":
+        logging.info("Command tree unchanged, skipping sync")
+        return False
+    started = time.perf_counter()
     await bot.tree.sync()
-    logging.info(f"{bot.user} is online!")
+    STARTUP["command_sync"] = time.perf_counter() - started
+    saved[key] = digest
+    try:
+        path.write_text(json.dumps(saved))
+    except OSError as e:
+        logging.warning(f"Failed to store command tree hash: {e}")
+    logging.info(f"Synced command tree in {STARTUP['command_sync']:.2f}s")
+    return True
+
+QUEUE_PAGE_SIZE = 10
+QUEUE_VIEW_TIMEOUT = 180
+QUEUE_TITLE_MAX = 80
+
+def format_duration(seconds):
+    # Cùng định dạng H:MM:SS với str(timedelta) nhưng rẻ hơn nhiều
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}"
+
+def render_queue_page(guild_id, page):
+    """Dựng embed cho một trang queue, chỉ duyệt các bài của trang đó. Trả về (embed, page, pages)."""
+    queue = SONG_QUEUES.get(guild_id) or TrackQueue()
+    pages = max(1, -(-len(queue) // QUEUE_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    start = page * QUEUE_PAGE_SIZE
+
+    lines = []
+    for i, track in enumerate(queue.iter_range(start, start + QUEUE_PAGE_SIZE), start + 1):
+        title = track.title if len(track.title) <= QUEUE_TITLE_MAX else track.title[:QUEUE_TITLE_MAX - 1] + "…"
+        lines.append(f"**{i}.** {title} `{format_duration(track.duration)}` · {track.requester}")
+
+    # total_duration được queue cập nhật mỗi lần thêm/bớt bài, không phải cộng lại
+    remaining = queue.total_duration
+    song = CURRENT_SONG.get(guild_id)
+    if song and song.get("duration"):
+        remaining += max(0, song["duration"] - current_position(guild_id))
+    embed = discord.Embed(title="Song Queue", description="\n".join(lines), color=discord.Color.blue())
+    embed.add_field(name="Songs", value=str(len(queue)), inline=True)
+    embed.add_field(name="Total duration", value=format_duration(queue.total_duration), inline=True)
+    embed.add_field(name="Remaining", value=format_duration(remaining), inline=True)
+    embed.set_footer(text=f"Page {page + 1}/{pages}")
+    return embed, page, pages
+
+class QueueView(discord.ui.View):
+    """Nút chuyển trang cho /queue. Mỗi lần bấm chỉ dựng lại trang đang xem từ queue hiện tại."""
+
+    def __init__(self, guild_id, page=0):
+        super().__init__(timeout=QUEUE_VIEW_TIMEOUT)
+        self.guild_id = guild_id
+        self.page = page
+        self.pages = 1
+        self.message = None
+
+    def render(self):
+        embed, self.page, self.pages = render_queue_page(self.guild_id, self.page)
+        self.first.disabled = self.previous.disabled = self.page == 0
+        self.next.disabled = self.last.disabled = self.page >= self.pages - 1
+        return embed
+
+    async def _show(self, interaction, page):
+        self.page = page
+        await interaction.response.edit_message(embed=self.render(), view=self)
+
+    @discord.ui.button(label="«", style=discord.ButtonStyle.secondary)
+    async def first(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, 0)
+
+    @discord.ui.button(label="‹", style=discord.ButtonStyle.primary)
+    async def previous(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, self.page - 1)
+
+    @discord.ui.button(label="›", style=discord.ButtonStyle.primary)
+    async def next(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, self.page + 1)
+
+    @discord.ui.button(label="»", style=discord.ButtonStyle.secondary)
+    async def last(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, self.pages - 1)
+
+    async def on_timeout(self):
+        if self.message is None:
+            return
+        for item in self.children:
+            item.disabled = True
+        try:
+            await self.message.edit(view=self)
+        except discord.HTTPException:
+            pass
 
 @bot.tree.command(name="queue", description="Show the current song queue")
-async def queue(interaction: discord.Interaction):
+@app_commands.describe(page="Page to show (10 songs per page)")
+async def queue(interaction: discord.Interaction, page: int = 1):
     guild_id = str(interaction.guild_id)
-    queue = SONG_QUEUES.get(guild_id, deque())
     
-    if not queue:
+    if not SONG_QUEUES.get(guild_id):
         await interaction.response.send_message(embed=discord.Embed(
             title="Queue", 
             description="The queue is empty!", 
@@ -181,21 +812,19 @@ async def queue(interaction: discord.Interaction):
         ))
         return
 
-    embed = discord.Embed(title="Song Queue", color=discord.Color.blue())
-    for i, (_, title, duration, requester) in enumerate(queue, 1):
-        duration_str = str(datetime.timedelta(seconds=int(duration)))
-        embed.add_field(
-            name=f"{i}. {title}",
-            value=f"Duration: {duration_str} | Requested by: {requester}",
-            inline=False
-        )
-    await interaction.response.send_message(embed=embed)
+    view = QueueView(guild_id, page - 1)
+    embed = view.render()
+    if view.pages == 1:
+        await interaction.response.send_message(embed=embed)
+        return
+    await interaction.response.send_message(embed=embed, view=view)
+    view.message = await interaction.original_response()
 
 @bot.tree.command(name="remove", description="Remove a song from the queue by position")
 @app_commands.describe(position="Position of the song in the queue")
 async def remove(interaction: discord.Interaction, position: int):
     guild_id = str(interaction.guild_id)
-    queue = SONG_QUEUES.get(guild_id, deque())
+    queue = SONG_QUEUES.get(guild_id, TrackQueue())
     
     if position < 1 or position > len(queue):
         await interaction.response.send_message(embed=discord.Embed(
@@ -205,18 +834,42 @@ async def remove(interaction: discord.Interaction, position: int):
         ))
         return
 
-    song = queue[position - 1]
-    queue.remove(song)
+    song = queue.pop(position - 1)
+    STATE_STORE.mark_dirty(guild_id)
+    ensure_prefetch(guild_id)
     await interaction.response.send_message(embed=discord.Embed(
         title="Removed", 
-        description=f"Removed: **{song[1]}** from position {position}", 
+        description=f"Removed: **{song.title}** from position {position}", 
+        color=discord.Color.green()
+    ))
+
+@bot.tree.command(name="move", description="Move a song to another position in the queue")
+@app_commands.describe(position="Current position of the song", new_position="New position in the queue")
+async def move(interaction: discord.Interaction, position: int, new_position: int):
+    guild_id = str(interaction.guild_id)
+    queue = SONG_QUEUES.get(guild_id, TrackQueue())
+    
+    if position < 1 or position > len(queue) or new_position < 1 or new_position > len(queue):
+        await interaction.response.send_message(embed=discord.Embed(
+            title="Error", 
+            description="Invalid position!", 
+            color=discord.Color.red()
+        ))
+        return
+
+    song = queue.move(position - 1, new_position - 1)
+    STATE_STORE.mark_dirty(guild_id)
+    ensure_prefetch(guild_id)
+    await interaction.response.send_message(embed=discord.Embed(
+        title="Moved", 
+        description=f"Moved: **{song.title}** to position {new_position}", 
         color=discord.Color.green()
     ))
 
 @bot.tree.command(name="shuffle", description="Shuffle the current queue")
 async def shuffle(interaction: discord.Interaction):
     guild_id = str(interaction.guild_id)
-    queue = SONG_QUEUES.get(guild_id, deque())
+    queue = SONG_QUEUES.get(guild_id, TrackQueue())
     
     if not queue:
         await interaction.response.send_message(embed=discord.Embed(
@@ -226,9 +879,9 @@ async def shuffle(interaction: discord.Interaction):
         ))
         return
 
-    queue_list = list(queue)
-    random.shuffle(queue_list)
-    SONG_QUEUES[guild_id] = deque(queue_list)
+    queue.shuffle()
+    STATE_STORE.mark_dirty(guild_id)
+    ensure_prefetch(guild_id)
     await interaction.response.send_message(embed=discord.Embed(
         title="Shuffled", 
         description="The queue has been shuffled!", 
@@ -250,18 +903,78 @@ async def loop(interaction: discord.Interaction, mode: str):
         return
 
     LOOP_STATES[guild_id] = mode
+    STATE_STORE.mark_dirty(guild_id)
     await interaction.response.send_message(embed=discord.Embed(
         title="Loop Mode", 
         description=f"Loop mode set to: **{mode}**", 
         color=discord.Color.green()
     ))
 
+@bot.tree.command(name="diagnostics", description="Admin: start, stop, reset or dump profiling diagnostics")
+@app_commands.describe(action="start, stop, reset or dump")
+@app_commands.default_permissions(administrator=True)
+async def diagnostics(interaction: discord.Interaction, action: str):
+    action = action.lower()
+    if action not in ["start", "stop", "reset", "dump"]:
+        await interaction.response.send_message(embed=discord.Embed(
+            title="Error", 
+            description="Invalid action! Use 'start', 'stop', 'reset' or 'dump'.", 
+            color=discord.Color.red()
+        ), ephemeral=True)
+        return
+
+    if action == "start":
+        DIAGNOSTICS.start(asyncio.get_running_loop())
+        description = "Diagnostics mode is on: sampling stacks and tracing slow callbacks."
+    elif action == "stop":
+        DIAGNOSTICS.stop()
+        description = "Diagnostics mode is off. Collected data is kept until reset."
+    elif action == "reset":
+        DIAGNOSTICS.reset()
+        description = "Diagnostics data cleared."
+    if action != "dump":
+        logging.info(f"Diagnostics {action} by {interaction.user}")
+        await interaction.response.send_message(embed=discord.Embed(
+            title="Diagnostics", 
+            description=description, 
+            color=discord.Color.green()
+        ), ephemeral=True)
+        return
+
+    report = diagnostics_report()
+    embed = discord.Embed(title="Diagnostics", color=discord.Color.blue())
+    embed.add_field(name="Mode", value="on" if report["enabled"] else "off", inline=True)
+    embed.add_field(name="Samples", value=str(report["samples"]), inline=True)
+    embed.add_field(name="Loop lag", value=f"{report['loop_lag'] * 1000:.0f} ms", inline=True)
+    slow = report["slow_callbacks"][-5:]
+    embed.add_field(name=f"Slow callbacks ({len(DIAGNOSTICS.slow_events)})", value="\n".join(
+        f"{item['seconds'] * 1000:.0f} ms in `{item['stack'][-1][:60]}`" for item in slow
+    ) or "None", inline=False)
+    jitter = report["frame_jitter"].get(str(interaction.guild_id))
+    embed.add_field(name="Frame jitter (this server)", value=(
+        f"avg {jitter['avg'] * 1000:.1f} ms, max {jitter['max'] * 1000:.0f} ms, {jitter['late_frames']} late frames"
+        if jitter else "Not playing"
+    ), inline=False)
+    plays = report["plays"][-3:]
+    embed.add_field(name="Recent /play", value="\n".join(
+        f"{play['total'] * 1000:.0f} ms: " + ", ".join(f"{stage} {seconds * 1000:.0f}" for stage, seconds in play["stages"].items())
+        for play in plays
+    )[:1024] or "None", inline=False)
+
+    files = []
+    if DIAGNOSTICS.samples:
+        files.append(discord.File(io.BytesIO(DIAGNOSTICS.folded().encode()), filename="profile.folded"))
+    if DIAGNOSTICS.slow_samples:
+        files.append(discord.File(io.BytesIO(DIAGNOSTICS.folded(slow_only=True).encode()), filename="slow.folded"))
+    await interaction.response.send_message(embed=embed, files=files, ephemeral=True)
+
 @bot.tree.command(name="nowplaying", description="Show details of the current song")
 async def nowplaying(interaction: discord.Interaction):
     guild_id = str(interaction.guild_id)
     voice_client = interaction.guild.voice_client
+    player = PLAYERS.get(guild_id)
     
-    if not voice_client or not voice_client.is_playing():
+    if not voice_client or player is None or not player.is_busy():
         await interaction.response.send_message(embed=discord.Embed(
             title="Error", 
             description="No song is currently playing!", 
@@ -278,31 +991,32 @@ async def nowplaying(interaction: discord.Interaction):
         ))
         return
 
-    current_time = time.time()
-    start_time = song_info.get("start_time", current_time)
+    position = current_position(guild_id)
     duration = song_info.get("duration", 0)
     if duration > 0:
-        progress = (current_time - start_time) / duration
+        progress = position / duration
         progress = min(max(progress, 0), 1)
         bar_length = 20
         filled = int(bar_length * progress)
         bar = "█" * filled + "▒" * (bar_length - filled)
-        progress_str = f"{bar} {int(progress * 100)}%"
+        progress_str = f"{bar} {format_duration(position)} / {format_duration(duration)}"
     else:
-        progress_str = "N/A"
+        progress_str = f"{format_duration(position)} / N/A"
 
     embed = discord.Embed(title="Now Playing", color=discord.Color.blue())
     embed.add_field(name="Index", value=song_info.get("index", "N/A"), inline=True)
     embed.add_field(name="Title", value=song_info.get("title", "Unknown"), inline=False)
-    embed.add_field(name="Duration", value=str(datetime.timedelta(seconds=int(song_info.get("duration", 0)))), inline=True)
+    embed.add_field(name="Duration", value=format_duration(song_info.get("duration", 0)), inline=True)
     embed.add_field(name="Requested by", value=song_info.get("requester", "Unknown"), inline=True)
+    embed.add_field(name="Status", value=player.status().capitalize(), inline=True)
     embed.add_field(name="Progress", value=progress_str, inline=False)
     await interaction.response.send_message(embed=embed)
 
 @bot.tree.command(name="skip", description="Skips the current playing song")
 async def skip(interaction: discord.Interaction):
-    if interaction.guild.voice_client and (interaction.guild.voice_client.is_playing() or interaction.guild.voice_client.is_paused()):
-        interaction.guild.voice_client.stop()
+    player = PLAYERS.get(str(interaction.guild_id))
+    if interaction.guild.voice_client and player is not None and player.is_busy():
+        player.skip()
         await interaction.response.send_message(embed=discord.Embed(
             title="Skipped", 
             description="Skipped the current song.", 
@@ -315,6 +1029,44 @@ async def skip(interaction: discord.Interaction):
             color=discord.Color.red()
         ))
 
+@bot.tree.command(name="seek", description="Jump to a position in the current song")
+@app_commands.describe(position="Position like 90, 1:30 or 1:02:03")
+async def seek(interaction: discord.Interaction, position: str):
+    player = PLAYERS.get(str(interaction.guild_id))
+    if not interaction.guild.voice_client or player is None or player.state != PLAYER_PLAYING or player.current is None:
+        await interaction.response.send_message(embed=discord.Embed(
+            title="Error", 
+            description="No song is currently playing!", 
+            color=discord.Color.red()
+        ))
+        return
+
+    try:
+        seconds = parse_timestamp(position)
+    except ValueError:
+        await interaction.response.send_message(embed=discord.Embed(
+            title="Error", 
+            description="Invalid position! Use seconds or mm:ss, e.g. `90` or `1:30`.", 
+            color=discord.Color.red()
+        ))
+        return
+
+    song = player.current
+    if song.duration and seconds >= song.duration:
+        await interaction.response.send_message(embed=discord.Embed(
+            title="Error", 
+            description=f"Position is past the end of the song ({format_duration(song.duration)}).", 
+            color=discord.Color.red()
+        ))
+        return
+
+    player.seek(seconds)
+    await interaction.response.send_message(embed=discord.Embed(
+        title="Seeked", 
+        description=f"Jumped to **{format_duration(seconds)}** in **{song.title}**.", 
+        color=discord.Color.green()
+    ))
+
 @bot.tree.command(name="pause", description="Pause the currently playing song")
 async def pause(interaction: discord.Interaction):
     voice_client = interaction.guild.voice_client
@@ -381,6 +1133,20 @@ async def stop(interaction: discord.Interaction):
         SONG_QUEUES[guild_id].clear()
     if guild_id in LOOP_STATES:
         LOOP_STATES[guild_id] = "off"
+    for task in PLAYLIST_TASKS.pop(guild_id, ()):
+        task.cancel()
+    GUILD_RESOLVE_SLOTS.pop(guild_id, None)
+    player = PLAYERS.pop(guild_id, None)
+    if player is not None:
+        player.current = None  # dừng hẳn, không giữ vị trí để phát tiếp
+        player.stopping = True
+        player.task.cancel()
+    cancel_prefetch(guild_id)
+    CURRENT_SONG.pop(guild_id, None)
+    RESUME_OFFSETS.pop(guild_id, None)
+    VOICE_CHANNELS.pop(guild_id, None)
+    FINISHED_AT.pop(guild_id, None)
+    STATE_STORE.mark_dirty(guild_id)
 
     if voice_client.is_playing() or voice_client.is_paused():
         voice_client.stop()
@@ -395,6 +1161,7 @@ async def stop(interaction: discord.Interaction):
 @bot.tree.command(name="play", description="Play a song or playlist or add it to the queue")
 @app_commands.describe(query="Song name, YouTube URL, or playlist URL")
 async def play(interaction: discord.Interaction, query: str):
+    requested_at = time.perf_counter()
     await interaction.response.defer(thinking=True)
 
     if interaction.user.voice is None:
@@ -405,23 +1172,95 @@ async def play(interaction: discord.Interaction, query: str):
         ))
         return
 
+    guild_id = str(interaction.guild_id)
+    cached = METADATA_CACHE.lookup(query)
+    rejected = admission_error(guild_id, query, needs_search=cached is None)
+    if rejected:
+        reason, message = rejected
+        ADMISSION_REJECTED.inc(reason=reason)
+        logging.info(f"Rejected /play for guild {guild_id} ({reason}): {query}")
+        await interaction.followup.send(embed=discord.Embed(
+            title="Busy" if reason == "overloaded" else "Error", 
+            description=message, 
+            color=discord.Color.red()
+        ))
+        return
+
+    trace = PlayTrace(guild_id, query, started=requested_at)
+    trace.mark("admission")
+    PLAYS_IN_FLIGHT[guild_id] = PLAYS_IN_FLIGHT.get(guild_id, 0) + 1
+    try:
+        await _play_admitted(interaction, query, cached, trace)
+    finally:
+        PLAYS_IN_FLIGHT[guild_id] -= 1
+        if not PLAYS_IN_FLIGHT[guild_id]:
+            del PLAYS_IN_FLIGHT[guild_id]
+
+def admission_error(guild_id, query, needs_search):
+    """Trả về (reason, thông báo cho người dùng) nếu /play này phải bị từ chối, None nếu được nhận."""
+    queue = SONG_QUEUES.get(guild_id)
+    if queue is not None and len(queue) >= GUILD_MAX_QUEUE:
+        return "queue_full", QUEUE_FULL_MESSAGE
+    if PLAYS_IN_FLIGHT.get(guild_id, 0) >= GUILD_MAX_PENDING_PLAYS:
+        return "guild_busy", "This server already has several songs being looked up. Please wait for them to finish."
+    if not needs_search:
+        return None  # có sẵn trong metadata cache, không tốn lượt search
+
+    # Quá tải: từ chối guild đang có việc dở (playlist, /play khác) trước, guild nhỏ
+    # xin một bài vẫn được nhận tới khi hàng đợi gấp đôi ngưỡng
+    waiting = EXTRACT_SCHEDULER.waiting(PRIORITY_SEARCH)
+    if waiting < EXTRACT_SHED_DEPTH:
+        return None
+    heavy = PLAYS_IN_FLIGHT.get(guild_id) or PLAYLIST_TASKS.get(guild_id) or is_playlist_url(query)
+    if heavy or waiting >= 2 * EXTRACT_SHED_DEPTH:
+        return "overloaded", "The bot is very busy right now. Please try again in a few seconds."
+    return None
+
+async def reject_queue_full(interaction, guild_id):
+    ADMISSION_REJECTED.inc(reason="queue_full")
+    logging.info(f"Queue of guild {guild_id} filled up while /play was looking up its song")
+    await interaction.followup.send(embed=discord.Embed(
+        title="Error", 
+        description=QUEUE_FULL_MESSAGE, 
+        color=discord.Color.red()
+    ))
+
+def is_playlist_url(query):
+    return "://" in query and "list" in parse_qs(urlparse(query).query)
+
+async def _play_admitted(interaction, query, cached, trace):
     voice_channel = interaction.user.voice.channel
     voice_client = interaction.guild.voice_client
     if voice_client is None:
         voice_client = await voice_channel.connect()
     elif voice_channel != voice_client.channel:
         await voice_client.move_to(voice_channel)
+    VOICE_CHANNELS[str(interaction.guild_id)] = voice_channel.id
+    trace.mark("voice_connect")
 
     try:
         start_time = time.time()
-        results = await search_ytdlp_async(query, ydl_opts=ydl_options)
-        logging.info(f"Search time for query '{query}': {time.time() - start_time:.2f}s")
-        
-        # Handle both single videos and playlists
-        if 'entries' in results:
-            tracks = [entry for entry in results['entries'] if entry is not None]
+        if cached:
+            tracks = [cached]
+            logging.info(f"Metadata cache hit for query '{query}'")
         else:
-            tracks = [results]
+            results = await search_ytdlp_async(query, ydl_opts=ydl_options, guild_id=str(interaction.guild_id))
+            logging.info(f"Search time for query '{query}': {time.time() - start_time:.2f}s")
+
+            # Handle both single videos and playlists
+            if 'entries' in results:
+                tracks = [entry for entry in results['entries'] if entry is not None]
+            else:
+                tracks = [results]
+
+            # Chỉ nhớ query -> video cho tìm kiếm từ khoá, URL video đã tra được theo video ID
+            if len(tracks) == 1 and "://" not in query:
+                METADATA_CACHE.put_query(query, tracks[0])
+                remember_titles(tracks, query=query)
+            else:
+                METADATA_CACHE.put_videos(tracks)
+                remember_titles(tracks)
+        trace.mark("cache" if cached else "search")
             
     except Exception as e:
         logging.error(f"Failed to fetch song for query '{query}': {str(e)}")
@@ -442,30 +1281,34 @@ async def play(interaction: discord.Interaction, query: str):
 
     guild_id = str(interaction.guild_id)
     if guild_id not in SONG_QUEUES:
-        SONG_QUEUES[guild_id] = deque()
-
-    added_songs = []
-    for track in tracks:
-        if not track:
-            continue
-
-        # === CHANGED: luôn resolve thành stream URL trực tiếp trước khi enqueue (có cookies) ===
-        resolved = await resolve_stream_url_async(track)
-        if not resolved:
-            logging.warning(f"Cannot resolve playable stream for: {track.get('title', 'Unknown')}")
+        SONG_QUEUES[guild_id] = TrackQueue()
+    # Queue có thể đã đầy (hoặc vượt, do playlist nền) trong lúc tìm bài
+    room = max(GUILD_MAX_QUEUE - len(SONG_QUEUES[guild_id]), 0)
+    if room == 0:
+        await reject_queue_full(interaction, guild_id)
+        return
+    truncated = len(tracks) > room
+    tracks = tracks[:room]
+
+    # Resolve entries until the first playable one, start it right away and
+    # leave the rest of the playlist to a background task.
+    first_title = None
+    remaining = []
+    for i, track in enumerate(tracks):
+        song = await _resolve_queue_item(track, interaction.user.name, guild_id=guild_id)
+        if song is None:
             continue
-
-        audio_url, fixed_title, fixed_duration = resolved
-        title = fixed_title or track.get("title", "Untitled")
-        duration = fixed_duration if fixed_duration is not None else track.get("duration", 0)
-
-        SONG_QUEUES[guild_id].append((audio_url, title, duration, interaction.user.name))
-        added_songs.append(title)
-    # === END CHANGED ===
-        
-    logging.info(f"Added songs to queue for guild {guild_id}: {added_songs}")
-
-    if not added_songs:
+        if len(SONG_QUEUES[guild_id]) >= GUILD_MAX_QUEUE:
+            await reject_queue_full(interaction, guild_id)  # đầy trong lúc resolve
+            return
+        SONG_QUEUES[guild_id].append(song)
+        STATE_STORE.mark_dirty(guild_id)
+        first_title = song.title
+        remaining = tracks[i + 1:]
+        break
+
+    trace.mark("resolve")
+    if first_title is None:
         await interaction.followup.send(embed=discord.Embed(
             title="Error", 
             description="No valid songs could be added to the queue.", 
@@ -473,98 +1316,683 @@ async def play(interaction: discord.Interaction, query: str):
         ))
         return
 
-    if len(added_songs) == 1:
-        message = f"Added to queue: **{added_songs[0]}**"
-    else:
-        message = f"Added {len(added_songs)} songs to queue."
+    logging.info(f"Added song to queue for guild {guild_id}: {first_title}")
 
-    if voice_client.is_playing() or voice_client.is_paused():
-        await interaction.followup.send(embed=discord.Embed(
+    if not voice_client.is_connected():
+        # Hết linger và rời voice trong lúc đang tìm bài: dùng kết nối mới nếu /play khác đã
+        # vào lại, không thì connect lại, để bài không bị xếp vào voice client đã đóng
+        voice_client = interaction.guild.voice_client
+        if voice_client is None or not voice_client.is_connected():
+            voice_client = await voice_channel.connect()
+        VOICE_CHANNELS[guild_id] = voice_channel.id
+
+    started = not is_player_busy(guild_id)
+    if not started:
+        embed = discord.Embed(
             title="Added", 
-            description=message, 
+            description=f"Added to queue: **{first_title}**", 
             color=discord.Color.green()
-        ))
+        )
     else:
-        await interaction.followup.send(embed=discord.Embed(
+        embed = discord.Embed(
             title="Playing", 
-            description=f"Now playing: **{added_songs[0]}**", 
+            description=f"Now playing: **{first_title}**", 
             color=discord.Color.green()
-        ))
+        )
+        PLAY_TRACES[guild_id] = trace  # player sẽ đánh dấu first_audio
         await play_next_song(voice_client, guild_id, interaction.channel)
 
-async def play_next_song(voice_client, guild_id, channel):
-    if not voice_client or not voice_client.is_connected():
-        logging.warning(f"Voice client not connected for guild {guild_id}")
-        return
+    if remaining:
+        embed.add_field(name="Playlist", value=f"Loading 1/{len(tracks)} songs...", inline=False)
+    if truncated:
+        embed.add_field(name="Queue limit",
+                        value=f"Only the first {len(tracks)} songs were added, the queue holds at most {GUILD_MAX_QUEUE}.",
+                        inline=False)
+    message = await interaction.followup.send(embed=embed, wait=True)
+    if not started:
+        trace.mark("reply")
+        finish_trace(trace)
+
+    if remaining:
+        task = asyncio.create_task(
+            _enqueue_remaining(voice_client, guild_id, interaction.channel, remaining,
+                               interaction.user.name, message, embed, len(tracks))
+        )
+        tasks = PLAYLIST_TASKS.setdefault(guild_id, set())
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+@play.autocomplete("query")
+async def play_autocomplete(interaction: discord.Interaction, current: str):
+    started = time.perf_counter()
+    text = current.strip()
+    if len(text) < AUTOCOMPLETE_MIN_CHARS or "://" in text:
+        return []
+
+    tracks = TITLE_INDEX.search(text)
+    source = "local"
+    if len(tracks) < AUTOCOMPLETE_REMOTE_BELOW:
+        key = normalize_query(text)
+        cached = AUTOCOMPLETE_CACHE.get(key)
+        if cached is not None:
+            tracks += cached
+            source = "cache"
+        else:
+            user_id = interaction.user.id
+            AUTOCOMPLETE_LATEST[user_id] = key
+            await asyncio.sleep(AUTOCOMPLETE_DEBOUNCE)
+            if AUTOCOMPLETE_LATEST.get(user_id) != key:
+                source = "debounced"  # người dùng vẫn đang gõ, chỉ trả gợi ý cục bộ
+            else:
+                del AUTOCOMPLETE_LATEST[user_id]
+                search = asyncio.ensure_future(_flat_search(key))
+                try:
+                    budget = AUTOCOMPLETE_BUDGET - (time.perf_counter() - started)
+                    tracks += await asyncio.wait_for(asyncio.shield(search), max(budget, 0))
+                    source = "search"
+                except asyncio.TimeoutError:
+                    source = "timeout"  # search vẫn chạy tiếp và vào cache cho phím sau
+
+    choices = []
+    seen = set()
+    for track in tracks:
+        url = track["webpage_url"]
+        if url in seen or len(url) > 100:
+            continue
+        seen.add(url)
+        suffix = f" ({format_duration(track['duration'])})" if track.get("duration") else ""
+        choices.append(app_commands.Choice(name=track["title"][:100 - len(suffix)] + suffix, value=url))
+    AUTOCOMPLETE_SECONDS.observe(time.perf_counter() - started, source=source)
+    return choices[:25]
+
+async def _resolve_queue_item(track, requester, priority=PRIORITY_PLAY_NOW, guild_id=None):
+    if not track:
+        return None
 
-    if guild_id not in SONG_QUEUES or not SONG_QUEUES[guild_id]:
-        if voice_client.is_connected():
-            await voice_client.disconnect()
-        logging.info(f"Queue empty, disconnected from voice for guild {guild_id}")
-        return
+    # Flat entries (search results, playlist items) already carry everything the
+    # queue needs, the stream URL is only resolved right before playback.
+    webpage_url = track.get("webpage_url") or track.get("url")
+    if not track.get("duration") and youtube_video_id(webpage_url):
+        track = METADATA_CACHE.get_video(youtube_video_id(webpage_url)) or track
+        webpage_url = track.get("webpage_url") or webpage_url
+    if webpage_url and track.get("title") and track.get("duration"):
+        return Track(webpage_url, track["title"], track["duration"], requester)
+
+    resolved = await resolve_stream_url_async(track, priority=priority, guild_id=guild_id)
+    if not resolved:
+        logging.warning(f"Cannot resolve playable stream for: {track.get('title', 'Unknown')}")
+        return None
+
+    webpage_url = resolved["webpage_url"]
+    cache_stream_url(webpage_url, resolved["url"], resolved["acodec"])
+    title = resolved["title"] or track.get("title", "Untitled")
+    duration = resolved["duration"] if resolved["duration"] is not None else track.get("duration", 0)
+    return Track(webpage_url, title, duration, requester)
 
+async def _enqueue_remaining(voice_client, guild_id, channel, tracks, requester, message, embed, total):
+    """
+    Resolve các entry còn lại của playlist song song (giới hạn bởi semaphore của guild)
+    rồi append vào queue đúng thứ tự playlist, cập nhật tiến độ lên follow-up message.
+    """
+    semaphore = GUILD_RESOLVE_SLOTS.get(guild_id)
+    if semaphore is None:
+        semaphore = GUILD_RESOLVE_SLOTS[guild_id] = asyncio.Semaphore(PLAYLIST_RESOLVE_CONCURRENCY)
+
+    async def resolve(track):
+        async with semaphore:
+            return await _resolve_queue_item(track, requester, priority=PRIORITY_BACKGROUND, guild_id=guild_id)
+
+    pending = [asyncio.create_task(resolve(track)) for track in tracks]
+    added = 1
+    failed = 0
+    skipped = 0
+    last_edit = time.monotonic()
     try:
-        song = SONG_QUEUES[guild_id].popleft()
-        audio_url, title, duration, requester = song
-        index = len(SONG_QUEUES[guild_id]) + 1
-    except (ValueError, IndexError) as e:
-        logging.error(f"Error unpacking queue item in guild {guild_id}: {e}")
-        SONG_QUEUES[guild_id].clear()
-        if voice_client.is_connected():
-            await voice_client.disconnect()
-        return
+        for done, task in enumerate(pending, 2):
+            song = await task
+            if not voice_client.is_connected() or guild_id not in SONG_QUEUES:
+                logging.info(f"Voice client gone, stopped loading playlist for guild {guild_id}")
+                break
+
+            if song is None:
+                failed += 1
+            elif len(SONG_QUEUES[guild_id]) >= GUILD_MAX_QUEUE:
+                skipped += 1  # queue đã đầy do các /play khác trong lúc nạp
+            else:
+                SONG_QUEUES[guild_id].append(song)
+                STATE_STORE.mark_dirty(guild_id)
+                added += 1
+                # The first song may already have finished while we were resolving.
+                await play_next_song(voice_client, guild_id, channel)
+
+            if time.monotonic() - last_edit >= PLAYLIST_PROGRESS_INTERVAL:
+                last_edit = time.monotonic()
+                embed.set_field_at(0, name="Playlist", value=f"Loading {done}/{total} songs...", inline=False)
+                try:
+                    await message.edit(embed=embed)
+                except discord.HTTPException as e:
+                    logging.warning(f"Failed to update playlist progress: {e}")
+    finally:
+        for task in pending:
+            task.cancel()
+
+    logging.info(f"Loaded playlist for guild {guild_id}: {added} added, {failed} failed, {skipped} skipped")
+    summary = f"Added {added} songs to queue."
+    if failed:
+        summary += f" ({failed} could not be played)"
+    if skipped:
+        summary += f" ({skipped} skipped, the queue is full)"
+    embed.set_field_at(0, name="Playlist", value=summary, inline=False)
+    try:
+        await message.edit(embed=embed)
+    except discord.HTTPException as e:
+        logging.warning(f"Failed to update playlist progress: {e}")
 
-    CURRENT_SONG[guild_id] = {
-        "title": title,
-        "duration": duration,
-        "requester": requester,
-        "url": audio_url,
-        "index": index,
-        "start_time": time.time()
-    }
-    logging.info(f"Attempting to play: {title} (URL: {audio_url}) for guild {guild_id}")
+    # Nothing may be left to play if the tail of the playlist failed to resolve.
+    PLAYLIST_TASKS.get(guild_id, set()).discard(asyncio.current_task())
+    if voice_client.is_connected():
+        await play_next_song(voice_client, guild_id, channel)
 
-    loop_mode = LOOP_STATES.get(guild_id, "off")
-    if loop_mode == "song":
-        SONG_QUEUES[guild_id].appendleft((audio_url, title, duration, requester))
-    elif loop_mode == "queue":
-        SONG_QUEUES[guild_id].append((audio_url, title, duration, requester))
+def cancel_prefetch(guild_id):
+    PREFETCH_URLS.pop(guild_id, None)
+    task = PREFETCH_TASKS.pop(guild_id, None)
+    if task:
+        task.cancel()
+    prefetched = PREFETCHED.pop(guild_id, None)
+    if prefetched:
+        prefetched[1].cleanup()
+
+def _take_prefetched(guild_id, webpage_url):
+    prefetched = PREFETCHED.pop(guild_id, None)
+    if not prefetched:
+        return None
+    url, source = prefetched
+    process = getattr(source, "_process", None)
+    if url != webpage_url or (process is not None and process.poll() is not None):
+        # Queue đã đổi (skip/remove/shuffle) hoặc ffmpeg đã chết trong lúc chờ
+        source.cleanup()
+        return None
+    return source
 
-    try:
-        source = discord.FFmpegPCMAudio(audio_url, **ffmpeg_options)
-    except Exception as e:
-        logging.error(f"FFmpeg failed to create source for {title}: {str(e)}")
-        await channel.send(embed=discord.Embed(
-            title="Error",
-            description=f"Failed to play {title}: {str(e)}",
-            color=discord.Color.red()
-        ))
-        await play_next_song(voice_client, guild_id, channel)
+def ensure_prefetch(guild_id):
+    """
+    Khi đang phát, chuẩn bị trước bài đầu queue. Gọi lại sau mọi thay đổi có thể đổi
+    đầu queue (/play, /remove, /move, /shuffle, playlist): prefetch cho bài cũ bị huỷ.
+    """
+    player = PLAYERS.get(guild_id)
+    if player is None or player.state != PLAYER_PLAYING:
+        return  # bài đầu queue sắp được phát ngay, không cần prefetch
+    queue = SONG_QUEUES.get(guild_id)
+    if not queue:
+        cancel_prefetch(guild_id)
+        return
+    if PREFETCH_URLS.get(guild_id) == queue[0].url:
+        return
+    cancel_prefetch(guild_id)
+    PREFETCH_URLS[guild_id] = queue[0].url
+    PREFETCH_TASKS[guild_id] = asyncio.create_task(_prefetch_next(player.voice_client, guild_id, queue[0]))
+
+async def _prefetch_next(voice_client, guild_id, song):
+    """Resolve trước bài kế tiếp, rồi mở sẵn ffmpeg khi bài hiện tại sắp hết."""
+    webpage_url, title = song.url, song.title
+    if cached_audio_path(webpage_url):
+        return  # phát từ file cục bộ, không cần resolve hay pre-warm
+    if not await get_stream_url_async(webpage_url, priority=PRIORITY_PREFETCH, guild_id=guild_id):
+        logging.warning(f"Prefetch could not resolve next song {title} for guild {guild_id}")
+        return
+    if PREWARM_SECONDS <= 0:
         return
 
-    def after_play(error):
-        if error:
-            logging.error(f"Playback error for {title}: {str(error)}")
+    while True:
+        song = CURRENT_SONG.get(guild_id)
+        if not song or not song.get("duration"):
+            return  # livestream / không rõ độ dài -> không biết lúc nào hết
+        remaining = song["duration"] - current_position(guild_id)
+        if remaining <= PREWARM_SECONDS and not voice_client.is_paused():
+            break
+        await asyncio.sleep(min(max(remaining - PREWARM_SECONDS, 1.0), 30))
+
+    queue = SONG_QUEUES.get(guild_id)
+    if not voice_client.is_connected() or not queue or queue[0].url != webpage_url:
+        return
+    # URL có thể đã hết hạn nếu bài hiện tại rất dài, lấy lại từ cache/resolve
+    stream = await get_stream_url_async(webpage_url, priority=PRIORITY_PLAY_NOW, guild_id=guild_id)
+    if stream:
+        try:
+            source = await create_audio_source(*stream)
+        except Exception as e:
+            logging.warning(f"Failed to pre-warm next song {title} for guild {guild_id}: {e}")
+            return
+        if PREFETCH_TASKS.get(guild_id) is asyncio.current_task():
+            PREFETCHED[guild_id] = (webpage_url, source)
+            logging.info(f"Pre-warmed next song {title} for guild {guild_id}")
         else:
-            logging.info(f"Finished playing {title} for guild {guild_id}")
-        
-        # Schedule the next song in the event loop
-        coro = play_next_song(voice_client, guild_id, channel)
-        asyncio.run_coroutine_threadsafe(coro, bot.loop)
+            source.cleanup()
+
+# Trạng thái player của mỗi guild (hiển thị ở /nowplaying)
+PLAYER_IDLE = "idle"
+PLAYER_RESOLVING = "resolving"
+PLAYER_PLAYING = "playing"
+PLAYER_BACKOFF = "retrying"
+PLAYER_STOPPED = "stopped"
+
+TRACK_MAX_ATTEMPTS = int(os.getenv("TRACK_MAX_ATTEMPTS", "3"))
+TRACK_RETRY_BACKOFF = 1.0  # giây, nhân đôi sau mỗi lần thử lại
+EARLY_END_SECONDS = 3      # bài dừng sớm hơn mức này coi như stream hỏng
+TRACK_END_TOLERANCE = 5    # stream dừng trước duration quá mức này coi như bị rớt giữa bài
+TRACK_MAX_RECOVERIES = int(os.getenv("TRACK_MAX_RECOVERIES", "10"))  # số lần phát tiếp sau khi rớt / bài
+QUARANTINE_SECONDS = 1800  # bài hỏng hết ngân sách thử lại bị bỏ qua trong chừng này giây
+QUARANTINE = {}            # webpage_url -> thời điểm hết cách ly
+PLAYERS = {}               # guild_id -> GuildPlayer
+
+# Hết queue thì ở lại voice chừng này giây trước khi rời (0 = rời ngay)
+IDLE_LINGER_SECONDS = float(os.getenv("IDLE_LINGER_SECONDS", "300"))
+VOICE_CHECK_INTERVAL = 5
+VOICE_RECONNECT_GRACE = 10  # cho discord.py tự reconnect trước khi supervisor can thiệp
+VOICE_DOWN_SINCE = {}       # guild_id -> monotonic lúc phát hiện voice bị rớt
+
+class GuildPlayer:
+    """
+    Một task sống lâu cho mỗi guild, lấy bài từ queue và phát lần lượt (không đệ quy).
+    Mỗi bài có ngân sách thử lại có backoff; bài hỏng hết ngân sách bị cách ly và
+    bỏ qua, các lỗi được gom thành một thông báo duy nhất.
+    """
 
-    try:
-        voice_client.play(source, after=after_play)
-        # Send now playing message
-        asyncio.run_coroutine_threadsafe(
-            channel.send(embed=discord.Embed(
+    def __init__(self, guild_id, voice_client, channel):
+        self.guild_id = guild_id
+        self.voice_client = voice_client
+        self.channel = channel
+        self.state = PLAYER_IDLE
+        self.failed = []  # (title, lỗi) chưa báo lên channel
+        self.skip_requested = False
+        self.stopping = False      # /stop hoặc player đã kết thúc: bài dừng không phải là chuyển bài
+        self._wakeup = asyncio.Event()
+        self._track_end = asyncio.Event()
+        self._track_error = None
+        self.current = None        # Track đang phát (hoặc đang thử phát)
+        self.source = None         # TrackedSource đang phát, đếm frame đã gửi
+        self._offset = 0.0         # vị trí khi không có source đang phát
+        self.seek_to = None        # /seek: vị trí cần phát lại từ đó
+        self.task = asyncio.create_task(self._run())
+
+    def status(self):
+        if self.state == PLAYER_PLAYING and self.voice_client.is_paused():
+            return "paused"
+        return self.state
+
+    def is_busy(self):
+        return self.state in (PLAYER_RESOLVING, PLAYER_PLAYING, PLAYER_BACKOFF)
+
+    def kick(self):
+        self._wakeup.set()
+
+    def skip(self):
+        self.skip_requested = True
+        if self.voice_client.is_playing() or self.voice_client.is_paused():
+            self.voice_client.stop()
+
+    def seek(self, seconds):
+        """Dừng source hiện tại, _play_track sẽ mở lại ffmpeg với -ss tại `seconds`."""
+        self.seek_to = seconds
+        if self.voice_client.is_playing() or self.voice_client.is_paused():
+            self.voice_client.stop()
+
+    def position(self):
+        """Vị trí (giây) trong bài đang phát, tính theo frame đã gửi cộng offset khi phát tiếp."""
+        source = self.source
+        if source is None:
+            return self._offset
+        return source.position()
+
+    def interrupt(self):
+        """Dừng player vì voice client bị thay, giữ bài đang phát để player mới phát tiếp."""
+        self._requeue_current()
+        self.task.cancel()
+
+    def _requeue_current(self):
+        song, self.current = self.current, None
+        if song is None:
+            return
+        guild_id = self.guild_id
+        queue = SONG_QUEUES.setdefault(guild_id, TrackQueue())
+        loop_mode = LOOP_STATES.get(guild_id, "off")
+        # Bài đã được loop "song"/"queue" đưa lại vào queue lúc bắt đầu phát
+        if not (loop_mode == "song" and queue and queue[0] is song):
+            if loop_mode == "queue" and queue and queue[-1] is song:
+                queue.pop(-1)
+            queue.appendleft(song)
+        position = self.position()
+        RESUME_OFFSETS[guild_id] = (song.url, position)
+        CURRENT_SONG.pop(guild_id, None)  # bài giờ nằm ở đầu queue, snapshot không được có nó hai lần
+        STATE_STORE.mark_dirty(guild_id)
+        logging.info(f"Keeping {song.title} at {position:.0f}s for guild {guild_id} after voice loss")
+
+    def _after_play(self, error):
+        # Chạy trên thread audio của discord.py
+        finished = time.perf_counter()
+        if not self.stopping:
+            FINISHED_AT[self.guild_id] = finished
+        bot.loop.call_soon_threadsafe(self._on_track_end, error, finished)
+
+    def _on_track_end(self, error, finished):
+        AFTER_PLAY_DELAY_SECONDS.observe(time.perf_counter() - finished)
+        self._track_error = error
+        self._track_end.set()
+
+    async def _run(self):
+        guild_id = self.guild_id
+        try:
+            while self.voice_client.is_connected():
+                queue = SONG_QUEUES.get(guild_id)
+                if not queue:
+                    FINISHED_AT.pop(guild_id, None)  # thời gian chờ / linger không phải khoảng lặng giữa hai bài
+                    self._report_failures()
+                    if PLAYLIST_TASKS.get(guild_id):
+                        logging.info(f"Queue empty, waiting for playlist to load for guild {guild_id}")
+                        self.state = PLAYER_IDLE
+                        self._wakeup.clear()
+                        await self._wakeup.wait()
+                        continue
+                    CURRENT_SONG.pop(guild_id, None)
+                    STATE_STORE.mark_dirty(guild_id)
+                    if IDLE_LINGER_SECONDS > 0:
+                        # Giữ kết nối voice một lúc để /play tiếp theo không phải connect lại
+                        logging.info(f"Queue empty, staying in voice for {IDLE_LINGER_SECONDS:.0f}s for guild {guild_id}")
+                        self.state = PLAYER_IDLE
+                        self._wakeup.clear()
+                        try:
+                            await asyncio.wait_for(self._wakeup.wait(), IDLE_LINGER_SECONDS)
+                            continue
+                        except asyncio.TimeoutError:
+                            if SONG_QUEUES.get(guild_id):
+                                continue
+                    VOICE_CHANNELS.pop(guild_id, None)
+                    STATE_STORE.mark_dirty(guild_id)
+                    await self.voice_client.disconnect()
+                    OUTBOX.forget(self.channel.id)
+                    logging.info(f"Queue empty, disconnected from voice for guild {guild_id}")
+                    break
+
+                song = queue.popleft()
+                STATE_STORE.mark_dirty(guild_id)
+                if QUARANTINE.get(song.url, 0) > time.time():
+                    self.failed.append((song.title, "failed repeatedly, skipped"))
+                    TRACK_RESULTS.inc(result="quarantined")
+                    continue
+                played = await self._play_track(song, len(queue) + 1)
+                if not self.voice_client.is_connected() and not self.skip_requested:
+                    # Voice bị rớt giữa bài: giữ bài lại để supervisor reconnect rồi phát tiếp
+                    self._requeue_current()
+                    break
+                self.current = None
+                if played:
+                    TRACK_RESULTS.inc(result="played")
+                else:
+                    QUARANTINE[song.url] = time.time() + QUARANTINE_SECONDS
+                    TRACK_RESULTS.inc(result="failed")
+        except Exception:
+            logging.exception(f"Player crashed for guild {guild_id}")
+        finally:
+            self.state = PLAYER_STOPPED
+            self.stopping = True
+            FINISHED_AT.pop(guild_id, None)
+            if self.current is not None:
+                # Bị huỷ giữa bài (vd. bot tắt): giữ vị trí cho snapshot cuối và lần phát tiếp
+                RESUME_OFFSETS[guild_id] = (self.current.url, self.position())
+            cancel_prefetch(guild_id)
+            if PLAYERS.get(guild_id) is self:
+                del PLAYERS[guild_id]
+
+    async def _play_track(self, song, index):
+        """Phát một bài với ngân sách thử lại. Trả về False nếu bài hỏng hẳn."""
+        guild_id = self.guild_id
+        CURRENT_SONG[guild_id] = {
+            "title": song.title,
+            "duration": song.duration,
+            "requester": song.requester,
+            "url": song.url,
+            "index": index,
+        }
+        TEXT_CHANNELS[guild_id] = self.channel.id
+        logging.info(f"Attempting to play: {song.title} for guild {guild_id}")
+
+        start = 0
+        resume = RESUME_OFFSETS.pop(guild_id, None)
+        if resume and resume[0] == song.url and resume[1] < (song.duration or float("inf")):
+            start = resume[1]
+            logging.info(f"Resuming {song.title} at {start:.0f}s for guild {guild_id}")
+        self.current = song
+        self.source = None
+        self._offset = start
+        self.seek_to = None
+
+        error = None
+        started_once = False
+        self.skip_requested = False
+        failures = 0     # lần thử liên tiếp không phát được gì
+        recoveries = 0   # lần phát tiếp sau khi stream rớt giữa bài
+        retry_delay = 0
+        while failures < TRACK_MAX_ATTEMPTS and recoveries <= TRACK_MAX_RECOVERIES:
+            if retry_delay:
+                self.state = PLAYER_BACKOFF
+                TRACK_RESULTS.inc(result="retried")
+                STREAM_CACHE.pop(song.url, None)  # URL cũ có thể đã chết, resolve lại
+                await asyncio.sleep(retry_delay)
+                retry_delay = 0
+                if self.skip_requested or not self.voice_client.is_connected():
+                    return True
+
+            self.state = PLAYER_RESOLVING
+            try:
+                source, prewarmed = await self._open_source(song, start)
+                if self.skip_requested:
+                    source.cleanup()
+                    return True
+                source = TrackedSource(source, start)
+                self._track_end.clear()
+                self._track_error = None
+                try:
+                    self.voice_client.play(source, after=self._after_play)
+                except Exception:
+                    source.cleanup()
+                    raise
+            except Exception as e:
+                error = e
+                failures += 1
+                retry_delay = TRACK_RETRY_BACKOFF * 2 ** (failures - 1)
+                logging.warning(f"Attempt {failures}/{TRACK_MAX_ATTEMPTS} failed for {song.title}: {e}")
+                continue
+
+            self.source = source
+            self.state = PLAYER_PLAYING
+            await self._on_started(song, prewarmed, first=not started_once)
+            started_once = True
+            await self._track_end.wait()
+            position = self._offset = source.position()
+            self.source = None
+            played = position - start
+
+            if self.skip_requested or not self.voice_client.is_connected():
+                return True
+            if self.seek_to is not None:
+                start, self.seek_to = self.seek_to, None
+                FINISHED_AT.pop(guild_id, None)  # không tính là khoảng lặng giữa hai bài
+                logging.info(f"Seeking {song.title} to {start:.0f}s for guild {guild_id}")
+                continue
+            cut_short = song.duration > 0 and position < song.duration - TRACK_END_TOLERANCE
+            # Dừng ngay sau khi mở (URL chết, kể cả livestream / bài không rõ duration) là lỗi,
+            # trừ khi source đã phát tới cuối bài (bài rất ngắn hoặc phát tiếp sát cuối bài)
+            reached_end = song.duration > 0 and source.frames > 0 and not cut_short
+            ended_early = played < EARLY_END_SECONDS and not reached_end
+            if self._track_error is None and not cut_short and not ended_early:
+                logging.info(f"Finished playing {song.title} for guild {guild_id}")
+                return True
+            if recoveries and self._track_error is None and played < EARLY_END_SECONDS:
+                # Phát tiếp mà không còn audio: duration của metadata dài hơn stream thật
+                logging.info(f"No audio left after {position:.0f}s of {song.title}, treating it as finished")
+                return True
+
+            if self._track_error is not None:
+                error = self._track_error
+            elif ended_early:
+                error = RuntimeError("stream ended right after it started")
+            else:
+                error = RuntimeError(f"stream ended at {format_duration(position)} of {format_duration(song.duration)}")
+            FINISHED_AT.pop(guild_id, None)  # phát tiếp / thử lại cùng bài, không phải chuyển bài
+            if played >= EARLY_END_SECONDS:
+                # Stream rớt giữa bài (ffmpeg -reconnect đã bỏ cuộc): resolve lại và phát tiếp từ frame cuối đã gửi
+                recoveries += 1
+                failures = 0
+                retry_delay = TRACK_RETRY_BACKOFF
+                TRACK_RESULTS.inc(result="recovered")
+                logging.warning(f"Stream of {song.title} dropped at {position:.0f}s ({error}), "
+                                f"resuming ({recoveries}/{TRACK_MAX_RECOVERIES})")
+            else:
+                failures += 1
+                retry_delay = TRACK_RETRY_BACKOFF * 2 ** (failures - 1)
+                logging.warning(f"Playback of {song.title} failed after {played:.1f}s: {error}")
+            start = position
+
+        self.failed.append((song.title, str(error)))
+        return False
+
+    async def _open_source(self, song, start):
+        source = _take_prefetched(self.guild_id, song.url) if not start else None
+        if source is not None:
+            return source, True
+        local_path = cached_audio_path(song.url)
+        if local_path:
+            return create_local_audio_source(local_path, start=start), False
+        stream = await get_stream_url_async(song.url, guild_id=self.guild_id)
+        if not stream:
+            raise RuntimeError("could not resolve a playable stream")
+        return await create_audio_source(*stream, start=start), False
+
+    async def _on_started(self, song, prewarmed, first):
+        guild_id = self.guild_id
+        finished_at = FINISHED_AT.pop(guild_id, None)
+        if finished_at is not None:
+            gap = time.perf_counter() - finished_at
+            TRANSITION_GAP_SECONDS.observe(gap, prewarmed=str(prewarmed).lower())
+            logging.info(f"Track transition gap for guild {guild_id}: {gap * 1000:.0f} ms "
+                         f"({'pre-warmed' if prewarmed else 'cold start'})")
+
+        cancel_prefetch(guild_id)
+        trace = PLAY_TRACES.pop(guild_id, None)
+        if trace is not None:
+            trace.mark("first_audio")
+            STAGE_SECONDS.observe(trace.total(), stage="first_audio")
+            finish_trace(trace)
+        if first:
+            # Chỉ loop lại bài đã phát được, bài hỏng không được đưa lại vào queue
+            loop_mode = LOOP_STATES.get(guild_id, "off")
+            if loop_mode == "song":
+                SONG_QUEUES[guild_id].appendleft(song)
+            elif loop_mode == "queue":
+                SONG_QUEUES[guild_id].append(song)
+            STATE_STORE.mark_dirty(guild_id)
+            if AUDIO_CACHE is not None:
+                AUDIO_CACHE.record_play(youtube_video_id(song.url), song.url)
+        ensure_prefetch(guild_id)
+
+        if first:
+            self._report_failures()
+            OUTBOX.now_playing(self.channel, discord.Embed(
                 title="Now Playing", 
-                description=f"**{title}** (Requested by {requester})", 
+                description=f"**{song.title}** (Requested by {song.requester})", 
                 color=discord.Color.blue()
-            )),
-            bot.loop
-        )
-    except Exception as e:
-        logging.error(f"Voice client error for {title}: {str(e)}")
-        await play_next_song(voice_client, guild_id, channel)
+            ))
+
+    def _report_failures(self):
+        if not self.failed:
+            return
+        failed, self.failed = self.failed, []
+        lines = [f"- {title}" for title, _ in failed[:10]]
+        if len(failed) > 10:
+            lines.append(f"...and {len(failed) - 10} more")
+        OUTBOX.send(self.channel, discord.Embed(
+            title="Error",
+            description=f"Skipped {len(failed)} song(s) that could not be played:\n" + "\n".join(lines)
+                        + f"\nLast error: {failed[-1][1]}",
+            color=discord.Color.red()
+        ))
+
+async def play_next_song(voice_client, guild_id, channel):
+    """Đảm bảo guild có player đang chạy và đánh thức nó khi queue có bài mới."""
+    player = PLAYERS.get(guild_id)
+    if player is not None and player.voice_client is not voice_client:
+        player.interrupt()  # voice client cũ đã bị thay
+        player = None
+    if player is None or player.task.done():
+        player = PLAYERS[guild_id] = GuildPlayer(guild_id, voice_client, channel)
+    player.kick()
+    ensure_prefetch(guild_id)  # /play trong lúc đang phát: bài mới có thể là bài kế tiếp
+    return player
+
+def is_player_busy(guild_id):
+    player = PLAYERS.get(guild_id)
+    return player is not None and player.is_busy()
+
+async def supervise_voice():
+    """Phát hiện kết nối voice bị rớt, connect lại và phát tiếp bài đang dở từ vị trí cũ."""
+    while True:
+        await asyncio.sleep(VOICE_CHECK_INTERVAL)
+        for guild_id, channel_id in list(VOICE_CHANNELS.items()):
+            guild = bot.get_guild(int(guild_id))
+            voice_client = guild.voice_client if guild else None
+            if voice_client is not None and voice_client.is_connected():
+                VOICE_DOWN_SINCE.pop(guild_id, None)
+                continue
+            if guild is None or not SONG_QUEUES.get(guild_id):
+                # Không còn gì để phát (vd. đang chờ rời voice), không cần connect lại
+                VOICE_CHANNELS.pop(guild_id, None)
+                VOICE_DOWN_SINCE.pop(guild_id, None)
+                STATE_STORE.mark_dirty(guild_id)
+                continue
+            down_since = VOICE_DOWN_SINCE.setdefault(guild_id, time.monotonic())
+            if time.monotonic() - down_since < VOICE_RECONNECT_GRACE:
+                continue
 
-bot.run(TOKEN)
+            voice_channel = guild.get_channel(channel_id)
+            text_channel = guild.get_channel(TEXT_CHANNELS.get(guild_id) or 0)
+            if voice_channel is None or text_channel is None:
+                VOICE_CHANNELS.pop(guild_id, None)
+                VOICE_DOWN_SINCE.pop(guild_id, None)
+                continue
+            logging.warning(f"Voice connection lost for guild {guild_id}, reconnecting")
+            try:
+                if voice_client is not None:
+                    await voice_client.disconnect(force=True)
+                voice_client = await voice_channel.connect()
+            except Exception as e:
+                VOICE_RECONNECTS.inc(result="failed")
+                logging.warning(f"Voice reconnect failed for guild {guild_id}: {e}")
+                continue  # thử lại ở vòng sau
+            VOICE_RECONNECTS.inc(result="ok")
+            VOICE_DOWN_SINCE.pop(guild_id, None)
+            await play_next_song(voice_client, guild_id, text_channel)
+
+@bot.event
+async def on_voice_state_update(member, before, after):
+    # Bot bị kick khỏi voice hoặc bị kéo sang channel khác bởi người dùng
+    if bot.user is None or member.id != bot.user.id:
+        return
+    guild_id = str(member.guild.id)
+    if after.channel is None:
+        # Khi chính discord.py ngắt kết nối (lỗi mạng, reconnect hỏng) nó đặt
+        # _expecting_disconnect, lúc đó để supervisor connect lại; còn lại là bị kick
+        voice_client = member.guild.voice_client
+        connection = getattr(voice_client, "_connection", None)
+        if voice_client is not None and not getattr(connection, "_expecting_disconnect", False):
+            if VOICE_CHANNELS.pop(guild_id, None) is not None:
+                STATE_STORE.mark_dirty(guild_id)
+    elif guild_id in VOICE_CHANNELS:
+        VOICE_CHANNELS[guild_id] = after.channel.id
+
+STARTUP["init"] = time.perf_counter() - STARTUP_STARTED
+
+# Chỉ chạy bot khi chạy trực tiếp, để benchmark.py có thể import module này
+if __name__ == "__main__":
+    keep_alive()
+    # log_handler=None: log của discord.py cũng đi qua queue ở trên thay vì handler đồng bộ riêng
+    bot.run(TOKEN, log_handler=None)
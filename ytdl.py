@@ -0,0 +1,314 @@
+import os
+import base64
+import hashlib
+import importlib
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+# Các hàm blocking gọi yt-dlp. Module này không có side effect khi import để
+# extraction scheduler có thể chạy chúng trong thread pool hoặc process pool.
+# yt_dlp chỉ được import lần đầu khi cần (thường là lúc warm-up nền), vì riêng
+# việc import nó đã tốn vài trăm ms lúc khởi động bot.
+
+# Define ydl_options globally
+ydl_options = {
+    "format": "bestaudio[acodec=opus]/bestaudio/best",
+    "outtmpl": "%(extractor)s-%(id)s-%(title)s.%(ext)s",
+    "restrictfilenames": True,
+    "noplaylist": True,
+    "default_search": "ytsearch1",
+    "quiet": True,
+    "no_warnings": True,
+    "socket_timeout": 8,
+    "retries": 2,
+    "extractor_retries": 2,
+    "fragment_retries": 2,
+    "sleep_interval": 0.5,
+    "max_sleep_interval": 2,
+    "http_headers": {
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+        "Accept": "*/*",
+        "Referer": "https://www.youtube.com/",
+    },
+    "force_ipv4": True,
+    "source_address": "0.0.0.0",
+    "cookiefile": "cookies.txt",
+    "extract_flat": "in_playlist",
+    "cachedir": "/tmp/yt_dlp_cache",
+    "force_generic_extractor": True,
+    "geo_bypass": True,
+    "nocheckcertificate": True,
+    # (tuỳ chọn) giúp yt-dlp đổi client khi cần
+    # "extractor_args": {"youtube": {"player_client": ["web","android","ios"]}},
+}
+
+# Options cho bước resolve: cần full info + formats của đúng 1 video
+resolve_ydl_options = dict(ydl_options)
+resolve_ydl_options.update({
+    "extract_flat": False,            # cần full info + formats
+    "noplaylist": True,               # chỉ lấy 1 video
+    "quiet": True,
+    "force_generic_extractor": False, # dùng extractor gốc YouTube
+})
+
+# Options cho autocomplete: chỉ lấy danh sách kết quả tìm kiếm (flat), không resolve từng video
+flat_search_ydl_options = dict(ydl_options)
+flat_search_ydl_options.update({
+    "extract_flat": True,
+    "force_generic_extractor": False,
+    "socket_timeout": 3,
+    "retries": 0,
+    "extractor_retries": 0,
+})
+
+_yt_dlp = None
+_import_lock = threading.Lock()
+
+def yt_dlp_module():
+    global _yt_dlp
+    if _yt_dlp is None:
+        with _import_lock:
+            if _yt_dlp is None:
+                started = time.perf_counter()
+                _yt_dlp = importlib.import_module("yt_dlp")
+                logging.info(f"Imported yt_dlp in {time.perf_counter() - started:.2f}s")
+    return _yt_dlp
+
+COOKIES_CHECK_INTERVAL = 30  # giây giữa hai lần kiểm tra nguồn cookies
+YDL_POOL_SIZE = int(os.getenv("YDL_POOL_SIZE", "8"))
+
+_cookies_lock = threading.Lock()
+_cookies_state = {"signature": None, "generation": 0, "checked": 0.0}
+
+def refresh_cookies(cookies_path="cookies.txt"):
+    """
+    Decode YTDLP_COOKIES ra file một lần, chỉ ghi lại khi nguồn cookies đổi.
+    Trả về generation hiện tại, tăng mỗi khi cookies đổi để pool bỏ các instance cũ.
+    """
+    now = time.monotonic()
+    with _cookies_lock:
+        state = _cookies_state
+        if state["signature"] is not None and now - state["checked"] < COOKIES_CHECK_INTERVAL:
+            return state["generation"]
+        state["checked"] = now
+
+        path = Path(cookies_path)
+        cookies_b64 = os.getenv("YTDLP_COOKIES")
+        if cookies_b64:
+            signature = ("env", hashlib.sha256(cookies_b64.encode()).hexdigest())
+        elif path.exists():
+            signature = ("file", path.stat().st_mtime_ns)
+        else:
+            signature = ("missing",)
+        if signature == state["signature"]:
+            return state["generation"]
+
+        if cookies_b64:
+            # Ghi ra file tạm cạnh cookies.txt rồi os.replace: yt-dlp (kể cả ở process
+            # khác) đang đọc file cũ không bao giờ thấy file bị cắt dở
+            tmp_path = path.with_name(f"{path.name}.tmp-{os.getpid()}")
+            try:
+                tmp_path.write_bytes(base64.b64decode(cookies_b64))
+                os.replace(tmp_path, path)
+                logging.info(f"Loaded cookies from env to {path}")
+            except Exception as e:
+                logging.warning(f"Failed to write cookies from env: {e}")
+                tmp_path.unlink(missing_ok=True)
+        elif path.exists():
+            logging.info(f"Using existing cookies file at {path}")
+        else:
+            logging.warning("Cookies file not found and YTDLP_COOKIES is empty. YouTube may require login.")
+        state["signature"] = signature
+        state["generation"] += 1
+        return state["generation"]
+
+# === NEW: helper gắn cookies vào ydl options (dùng chung cho search & resolve) ===
+def prepare_ydl_opts(base_opts: dict) -> dict:
+    opts = dict(base_opts)  # copy để không đụng bản gốc
+    cookies_path = opts.get("cookiefile", "cookies.txt")
+    refresh_cookies(cookies_path)
+    if Path(cookies_path).exists():
+        opts["cookiefile"] = cookies_path
+    else:
+        opts.pop("cookiefile", None)
+    return opts
+# === END NEW ===
+
+class YoutubeDLPool:
+    """
+    Giữ sẵn các instance YoutubeDL đã khởi tạo (cookie jar, extractor) theo từng bộ options.
+    Mỗi instance chỉ được một thread dùng tại một thời điểm.
+    """
+
+    def __init__(self, size=YDL_POOL_SIZE):
+        self.size = size
+        self.created = 0
+        self.reused = 0
+        self._idle = {}  # options key -> [(generation, ydl)]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(opts):
+        return json.dumps(opts, sort_keys=True, default=str)
+
+    @contextmanager
+    def borrow(self, opts):
+        key = self._key(opts)
+        generation = refresh_cookies(opts.get("cookiefile", "cookies.txt"))
+        ydl = None
+        stale = []
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            while idle:
+                idle_generation, candidate = idle.pop()
+                if idle_generation == generation:
+                    ydl = candidate
+                    self.reused += 1
+                    break
+                stale.append(candidate)
+            if ydl is None:
+                self.created += 1
+        for old in stale:
+            _close(old)
+        if ydl is None:
+            ydl = yt_dlp_module().YoutubeDL(prepare_ydl_opts(opts))
+
+        try:
+            yield ydl
+        finally:
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self.size and generation == _cookies_state["generation"]:
+                    idle.append((generation, ydl))
+                    ydl = None
+            if ydl is not None:
+                _close(ydl)
+
+    def warm_up(self, opts, count):
+        with self._lock:
+            have = len(self._idle.get(self._key(opts), []))
+        borrowed = []
+        try:
+            for _ in range(max(0, count - have)):
+                cm = self.borrow(opts)
+                cm.__enter__()
+                borrowed.append(cm)
+        finally:
+            for cm in borrowed:
+                cm.__exit__(None, None, None)
+
+    def stats(self):
+        with self._lock:
+            idle = sum(len(v) for v in self._idle.values())
+        return {"created": self.created, "reused": self.reused, "idle": idle}
+
+def _close(ydl):
+    # Không ghi cookie jar ngược lại cookies.txt khi bỏ instance
+    ydl.params["cookiefile"] = None
+    try:
+        ydl.close()
+    except Exception as e:
+        logging.warning(f"Failed to close YoutubeDL instance: {e}")
+
+YDL_POOL = YoutubeDLPool()
+
+# Options tải file cho audio cache: giữ nguyên Opus, remux sang Ogg (.opus)
+download_ydl_options = dict(resolve_ydl_options)
+download_ydl_options.update({
+    "format": "bestaudio[acodec=opus]/bestaudio",
+    "postprocessors": [{"key": "FFmpegExtractAudio", "preferredcodec": "opus"}],
+})
+
+def download_audio(webpage_url, directory, video_id):
+    """Tải audio của video về `directory/<video_id>.opus`, trả về Path."""
+    final = Path(directory) / f"{video_id}.opus"
+    opts = dict(download_ydl_options, outtmpl=str(Path(directory) / f"{video_id}.tmp.%(ext)s"))
+    # outtmpl khác nhau mỗi lần nên không dùng pool
+    ydl = yt_dlp_module().YoutubeDL(prepare_ydl_opts(opts))
+    try:
+        info = ydl.extract_info(webpage_url, download=True)
+    finally:
+        _close(ydl)
+    downloaded = Path(info["requested_downloads"][0]["filepath"])
+    downloaded.replace(final)
+    return final
+
+def warm_up(count=2):
+    YDL_POOL.warm_up(ydl_options, count)
+    YDL_POOL.warm_up(resolve_ydl_options, count)
+
+def extract(query, ydl_opts):
+    with YDL_POOL.borrow(ydl_opts) as ydl:
+        try:
+            return ydl.sanitize_info(ydl.extract_info(query, download=False))
+        except Exception as e:
+            logging.error(f"yt-dlp extraction failed: {e}")
+            raise
+
+def search_flat(query, limit=5):
+    """Tìm `limit` video cho autocomplete, trả về [{title, duration, webpage_url}] không cần resolve."""
+    info = extract(f"ytsearch{limit}:{query}", flat_search_ydl_options)
+    results = []
+    for entry in info.get("entries") or ():
+        if entry and entry.get("title") and entry.get("url"):
+            results.append({
+                "title": entry["title"],
+                "duration": entry.get("duration") or 0,
+                "webpage_url": entry["url"],
+            })
+    return results
+
+def _stream_info(info, target):
+    return {
+        "url": info["url"],
+        "title": info.get("title", "Untitled"),
+        "duration": info.get("duration", 0),
+        "webpage_url": info.get("webpage_url") or target,
+        "acodec": info.get("acodec"),
+        "format_id": info.get("format_id"),
+    }
+
+# === NEW: helper resolve URL stream trực tiếp cho 1 entry (kể cả kênh/playlist/flat) ===
+def resolve_stream_url(entry):
+    """
+    Trả về dict (url, title, duration, webpage_url, acodec, format_id) đã được yt_dlp resolve thành URL audio trực tiếp.
+    Nếu entry là kênh/playlist/flat entry -> re-extract bằng extract_flat=False để lấy formats thật.
+    """
+    target = entry.get("webpage_url") or entry.get("url")
+    if not target:
+        return None
+
+    with YDL_POOL.borrow(resolve_ydl_options) as ydl:
+        try:
+            info = ydl.extract_info(target, download=False)
+        except Exception as e:
+            logging.error(f"Resolve stream failed for target={target}: {e}")
+            return None
+
+        # Nếu là list/playlist/channel -> chọn phần tử đầu là video và re-extract nếu cần
+        if isinstance(info, dict) and "entries" in info and info["entries"]:
+            for e in info["entries"]:
+                if not e:
+                    continue
+                sub_target = e.get("webpage_url") or e.get("url")
+                if not sub_target:
+                    continue
+                try:
+                    e2 = ydl.extract_info(sub_target, download=False)
+                    if e2 and e2.get("url"):
+                        return _stream_info(e2, sub_target)
+                except Exception as ex2:
+                    logging.warning(f"Second-stage resolve failed: {ex2}")
+                    continue
+            return None
+
+    # Trường hợp single video đã có stream URL
+    if info and info.get("url"):
+        return _stream_info(info, target)
+
+    return None
+# === END NEW ===